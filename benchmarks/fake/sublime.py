@@ -0,0 +1,554 @@
+"""
+Fake `sublime` module for running the plugin headless.
+
+Implements the parts of the API the plugin uses, backed by plain Python
+objects: views hold their text, a list of (begin, end, scope) ranges and
+their region sets, which are moved along edits like in the editor. Main
+thread callbacks queued with set_timeout() run in run_main(); async ones run
+on a background thread. View.api_calls counts calls into the "editor", and
+View.edit_seconds the time it spent applying edits.
+"""
+import fnmatch
+import queue
+import threading
+import time
+
+DRAW_EMPTY = 1
+HIDE_ON_MINIMAP = 2
+DRAW_EMPTY_AS_OVERWRITE = 4
+DRAW_NO_FILL = 32
+DRAW_NO_OUTLINE = 256
+DRAW_SOLID_UNDERLINE = 512
+DRAW_STIPPLED_UNDERLINE = 1024
+DRAW_SQUIGGLY_UNDERLINE = 2048
+PERSISTENT = 16
+HIDDEN = 128
+DRAW_OUTLINED = 256
+NO_UNDO = 8192
+CLASS_EMPTY_LINE = 4096
+HOVER_TEXT = 1
+
+_main = queue.Queue()
+_settings = {}
+_windows = []
+_ids = iter(range(1, 10**9))
+
+
+class Region:
+    __slots__ = ('a', 'b', 'xpos')
+
+    def __init__(self, a, b=None, xpos=-1):
+        if b is None:
+            b = a
+        self.a, self.b, self.xpos = a, b, xpos
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+    def intersects(self, r):
+        return self.begin() < r.end() and r.begin() < self.end()
+
+    def cover(self, r):
+        return Region(min(self.begin(), r.begin()), max(self.end(), r.end()))
+
+    def __eq__(self, o):
+        return isinstance(o, Region) and (self.a, self.b) == (o.a, o.b)
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __len__(self):
+        return self.size()
+
+    def __repr__(self):
+        return "Region(%d, %d)" % (self.a, self.b)
+
+
+class Settings:
+    def __init__(self, d=None):
+        self._d = dict(d or {})
+        self._cb = {}
+
+    def get(self, k, default=None):
+        return self._d.get(k, default)
+
+    def set(self, k, v):
+        self._d[k] = v
+        for cb in list(self._cb.values()):
+            cb()
+
+    def erase(self, k):
+        self._d.pop(k, None)
+        for cb in list(self._cb.values()):
+            cb()
+
+    def has(self, k):
+        return k in self._d
+
+    def add_on_change(self, tag, cb):
+        self._cb[tag] = cb
+
+    def clear_on_change(self, tag):
+        self._cb.pop(tag, None)
+
+
+class Selection(list):
+    def add(self, r):
+        self.append(r if isinstance(r, Region) else Region(r))
+
+    def add_all(self, rs):
+        for r in rs:
+            self.add(r)
+
+
+class HistoricPosition:
+    def __init__(self, pt, row, col):
+        self.pt, self.row, self.col = pt, row, col
+
+
+class TextChange:
+    def __init__(self, a, b, s):
+        self.a = HistoricPosition(a, 0, 0)
+        self.b = HistoricPosition(b, 0, 0)
+        self.str = s
+        self.len_utf8 = b - a
+        self.len_utf16 = b - a
+
+    def __repr__(self):
+        return "TextChange(%d, %d, %r)" % (self.a.pt, self.b.pt, self.str)
+
+
+class Buffer:
+    def __init__(self, view):
+        self._views = [view]
+        self.buffer_id = next(_ids)
+
+    def id(self):
+        return self.buffer_id
+
+    def views(self):
+        return list(self._views)
+
+    def primary_view(self):
+        return self._views[0]
+
+
+class View:
+    def __init__(self, window=None, text="", scopes=None, file_name=None):
+        self.view_id = next(_ids)
+        self._window = window
+        self._text = text
+        self._scopes = scopes or []  # list of (a, b, scope)
+        self._regions = {}
+        self._sel = Selection()
+        self._settings = Settings()
+        self._change_count = 0
+        self._visible = None
+        self._status = {}
+        self._file_name = file_name
+        self._buffer = Buffer(self)
+        self.popups = []
+        self.api_calls = 0
+        self.edit_seconds = 0.0
+
+    def id(self):
+        return self.view_id
+
+    def buffer(self):
+        return self._buffer
+
+    def buffer_id(self):
+        return self._buffer.buffer_id
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._file_name
+
+    def is_loading(self):
+        return False
+
+    def is_valid(self):
+        return True
+
+    def size(self):
+        return len(self._text)
+
+    def substr(self, x):
+        self.api_calls += 1
+        if isinstance(x, Region):
+            return self._text[x.begin():x.end()]
+        return self._text[x:x + 1]
+
+    def sel(self):
+        return self._sel
+
+    def settings(self):
+        return self._settings
+
+    def change_count(self):
+        return self._change_count
+
+    def visible_region(self):
+        return self._visible or Region(0, min(self.size(), 3000))
+
+    def set_viewport(self, region):
+        self._visible = region
+
+    def text_point(self, row, col):
+        lines = self._text.split('\n')
+        return sum(len(l) + 1 for l in lines[:row]) + col
+
+    def rowcol(self, pt):
+        before = self._text[:pt]
+        row = before.count('\n')
+        return row, pt - (before.rfind('\n') + 1)
+
+    def line(self, x):
+        if isinstance(x, Region):
+            a, b = x.begin(), x.end()
+        else:
+            a = b = x
+        start = self._text.rfind('\n', 0, a) + 1
+        end = self._text.find('\n', b)
+        if end == -1:
+            end = len(self._text)
+        return Region(start, end)
+
+    def lines(self, r):
+        out = []
+        pt = r.begin()
+        while True:
+            line = self.line(pt)
+            out.append(line)
+            if line.end() >= r.end() or line.end() >= len(self._text):
+                break
+            pt = line.end() + 1
+        return out
+
+    def full_line(self, x):
+        r = self.line(x)
+        return Region(r.a, min(r.b + 1, len(self._text)))
+
+    def scope_name(self, pt):
+        self.api_calls += 1
+        names = ['text.plain']
+        for a, b, s in self._scopes:
+            if a <= pt < b:
+                names.append(s)
+        return ' '.join(names) + ' '
+
+    def extract_tokens_with_scopes(self, region):
+        self.api_calls += 1
+        cuts = {region.begin(), region.end()}
+        for a, b, _ in self._scopes:
+            if region.begin() < a < region.end():
+                cuts.add(a)
+            if region.begin() < b < region.end():
+                cuts.add(b)
+        cuts = sorted(cuts)
+        return [(Region(a, b), self.scope_name(a)) for a, b in zip(cuts, cuts[1:]) if a < b]
+
+    def match_selector(self, pt, selector):
+        return any(fnmatch.fnmatch(s, selector + '*') for s in self.scope_name(pt).split())
+
+    def add_regions(self, key, regions, scope="", icon="", flags=0, annotations=None, annotation_color=None, on_navigate=None, on_close=None):
+        self.api_calls += 1
+        self._regions[key] = [Region(r.a, r.b) for r in regions]
+
+    def get_regions(self, key):
+        self.api_calls += 1
+        return list(self._regions.get(key, []))
+
+    def erase_regions(self, key):
+        self.api_calls += 1
+        self._regions.pop(key, None)
+
+    def set_status(self, key, value):
+        self._status[key] = value
+
+    def erase_status(self, key):
+        self._status.pop(key, None)
+
+    def get_status(self, key):
+        return self._status.get(key, '')
+
+    def show_popup(self, content, flags=0, location=-1, max_width=320, max_height=240, on_navigate=None, on_hide=None):
+        self.popups.append(content)
+
+    def update_popup(self, content):
+        self.popups.append(content)
+
+    def hide_popup(self):
+        pass
+
+    def is_popup_visible(self):
+        return bool(self.popups)
+
+    def show_at_center(self, r):
+        pass
+
+    def show(self, r):
+        pass
+
+    def set_read_only(self, flag):
+        pass
+
+    def name(self):
+        return getattr(self, '_name', '')
+
+    def set_name(self, name):
+        self._name = name
+
+    def set_scratch(self, flag):
+        pass
+
+    def assign_syntax(self, syntax):
+        pass
+
+    # editing
+    def _apply(self, a, b, s):
+        start = time.perf_counter()
+        change = self._edit(a, b, s)
+        self.edit_seconds += time.perf_counter() - start
+        return change
+
+    def _edit(self, a, b, s):
+        self._text = self._text[:a] + s + self._text[b:]
+        delta = len(s) - (b - a)
+        for key, regs in self._regions.items():
+            for r in regs:
+                for attr in ('a', 'b'):
+                    v = getattr(r, attr)
+                    if v >= b:
+                        setattr(r, attr, v + delta)
+                    elif v > a:
+                        setattr(r, attr, a + len(s) if v > a else v)
+        new_scopes = []
+        for (sa, sb, sc) in self._scopes:
+            if sa >= b:
+                sa += delta
+            elif sa > a:
+                sa = a
+            if sb >= b:
+                sb += delta
+            elif sb > a:
+                sb = a + len(s)
+            if sb > sa:
+                new_scopes.append((sa, sb, sc))
+        self._scopes = new_scopes
+        self._change_count += 1
+        return TextChange(a, b, s)
+
+    def _notify(self, changes):
+        import sublime_plugin
+        for listener in sublime_plugin._text_change_listeners(self._buffer):
+            listener.on_text_changed(changes)
+        for listener in sublime_plugin._event_listeners():
+            if hasattr(listener, 'on_modified'):
+                listener.on_modified(self)
+
+    def insert(self, edit, pt, s):
+        change = self._apply(pt, pt, s)
+        edit.changes.append(change)
+        return len(s)
+
+    def replace(self, edit, r, s):
+        change = self._apply(r.begin(), r.end(), s)
+        edit.changes.append(change)
+
+    def erase(self, edit, r):
+        change = self._apply(r.begin(), r.end(), '')
+        edit.changes.append(change)
+
+    def type_text(self, pt, s, remove=0):
+        """Simulate a keystroke: replace `remove` characters at pt by s."""
+        change = self._apply(pt, pt + remove, s)
+        self._notify([change])
+
+    def run_command(self, name, args=None):
+        import sublime_plugin
+        return sublime_plugin._run_text_command(self, name, args or {})
+
+    def close(self):
+        import sublime_plugin
+        if self._window and self in self._window._views:
+            self._window._views.remove(self)
+        for listener in sublime_plugin._event_listeners():
+            if hasattr(listener, 'on_close'):
+                listener.on_close(self)
+
+
+class Edit:
+    def __init__(self):
+        self.changes = []
+
+
+class Window:
+    def __init__(self, folders=None):
+        self.window_id = next(_ids)
+        self._views = []
+        self._panels = {}
+        self._folders = folders or []
+        self.quick_panels = []
+        self._active = None
+        _windows.append(self)
+
+    def id(self):
+        return self.window_id
+
+    def new_file(self, text="", scopes=None, file_name=None):
+        v = View(self, text, scopes, file_name)
+        self._views.append(v)
+        self._active = v
+        return v
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        return self._active
+
+    def folders(self):
+        return list(self._folders)
+
+    def get_output_panel(self, name):
+        return self.create_output_panel(name)
+
+    def create_output_panel(self, name, unlisted=False):
+        if name not in self._panels:
+            self._panels[name] = View(self)
+        return self._panels[name]
+
+    def find_output_panel(self, name):
+        return self._panels.get(name)
+
+    def find_open_file(self, path):
+        for v in self._views:
+            if v.file_name() == path:
+                return v
+        return None
+
+    def open_file(self, path, flags=0):
+        v = self.find_open_file(path)
+        if v is None:
+            with open(path, encoding='utf-8') as f:
+                v = self.new_file(f.read(), file_name=path)
+        self._active = v
+        return v
+
+    def run_command(self, name, args=None):
+        import sublime_plugin
+        return sublime_plugin._run_window_command(self, name, args or {})
+
+    def show_quick_panel(self, items, on_select, flags=0, selected_index=-1, on_highlight=None, placeholder=None):
+        self.quick_panels.append((items, on_select))
+
+
+def load_settings(name):
+    if name not in _settings:
+        _settings[name] = Settings()
+    return _settings[name]
+
+
+def save_settings(name):
+    pass
+
+
+def set_timeout(cb, delay=0):
+    _main.put((time.monotonic() + delay / 1000.0, cb))
+
+
+_async = queue.Queue()
+
+
+def _async_loop():
+    while True:
+        cb = _async.get()
+        try:
+            cb()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+
+threading.Thread(target=_async_loop, daemon=True).start()
+
+
+def set_timeout_async(cb, delay=0):
+    if delay:
+        threading.Timer(delay / 1000.0, lambda: _async.put(cb)).start()
+    else:
+        _async.put(cb)
+
+
+def run_main(timeout=5.0, until=None):
+    """Drain main-thread callbacks, honouring delays, until `until()` or idle."""
+    deadline = time.monotonic() + timeout
+    pending = []
+    while time.monotonic() < deadline:
+        try:
+            pending.append(_main.get(timeout=0.01))
+        except queue.Empty:
+            pass
+        now = time.monotonic()
+        due = [p for p in pending if p[0] <= now]
+        pending = [p for p in pending if p[0] > now]
+        for _, cb in sorted(due, key=lambda p: p[0]):
+            cb()
+        if until is not None and until():
+            break
+        if until is None and not pending and _main.empty() and _async.empty():
+            time.sleep(0.02)
+            if _main.empty() and _async.empty():
+                break
+    for p in pending:
+        _main.put(p)
+
+
+_status = []
+
+
+def status_message(msg):
+    _status.append(msg)
+
+
+def active_window():
+    return _windows[-1] if _windows else Window()
+
+
+def windows():
+    return list(_windows)
+
+
+def platform():
+    return 'linux'
+
+
+def cache_path():
+    import tempfile
+    return tempfile.gettempdir()
+
+
+def packages_path():
+    import tempfile
+    return tempfile.gettempdir()
+
+
+def version():
+    return '4143'
@@ -0,0 +1,106 @@
+"""Fake `sublime_plugin` module, see sublime.py."""
+
+import re
+import sublime
+
+_classes = []
+
+
+def _snake(name):
+    if name.endswith('Command'):
+        name = name[:-7]
+    s = re.sub(r'(?<!^)(?=[A-Z])', '_', name)
+    return s.lower()
+
+
+class _Registered:
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        _classes.append(cls)
+
+
+class TextCommand(_Registered):
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(_Registered):
+    def __init__(self, window):
+        self.window = window
+
+
+class ApplicationCommand(_Registered):
+    pass
+
+
+class EventListener(_Registered):
+    pass
+
+
+class ViewEventListener(_Registered):
+    def __init__(self, view):
+        self.view = view
+
+
+class TextChangeListener(_Registered):
+    def __init__(self):
+        self.buffer = None
+
+
+_listeners = {}
+
+
+def _event_listeners():
+    out = []
+    for cls in _classes:
+        if issubclass(cls, EventListener) and cls is not EventListener:
+            if cls not in _listeners:
+                _listeners[cls] = cls()
+            out.append(_listeners[cls])
+    return out
+
+
+_tcl = {}
+
+
+def _text_change_listeners(buffer):
+    out = []
+    for cls in _classes:
+        if issubclass(cls, TextChangeListener) and cls is not TextChangeListener:
+            key = (cls, buffer.id())
+            if key not in _tcl:
+                inst = cls()
+                inst.buffer = buffer
+                _tcl[key] = inst
+            out.append(_tcl[key])
+    return out
+
+
+def _find(name, base):
+    for cls in reversed(_classes):
+        if issubclass(cls, base) and _snake(cls.__name__) == name:
+            return cls
+    return None
+
+
+def _run_text_command(view, name, args):
+    cls = _find(name, TextCommand)
+    if cls is None:
+        return None
+    edit = sublime.Edit()
+    cmd = cls(view)
+    if hasattr(cmd, 'is_enabled') and not cmd.is_enabled(**args):
+        return None
+    result = cmd.run(edit, **args)
+    if edit.changes:
+        view._notify(edit.changes)
+    return result
+
+
+def _run_window_command(window, name, args):
+    if name in ('show_panel', 'hide_panel'):
+        return None
+    cls = _find(name, WindowCommand)
+    if cls is None:
+        return None
+    return cls(window).run(**args)
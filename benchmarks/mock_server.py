@@ -0,0 +1,111 @@
+"""
+Mock LanguageTool server for benchmarks.
+
+Answers /v2/check with a match on every n-th word of the checked text (n
+being 1 / density) after a configurable latency, and /v2/languages with a
+static list. Supports keep-alive, gzip and the annotated `data` parameter.
+"""
+
+import gzip
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+WORD = re.compile(r'\w+')
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, density=0.1, port=0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.latency = latency
+        self.density = density
+        self.requests = 0
+        self.bytes = 0
+        self.languages = []  # language parameter of each check request
+        self.body = None  # if set, answered to check requests instead
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/v2/check' % self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def find_matches(self, text):
+        step = max(1, round(1 / self.density)) if self.density else 0
+        matches = []
+        if not step:
+            return matches
+        for index, word in enumerate(WORD.finditer(text)):
+            if index % step == 0:
+                matches.append({
+                    'message': 'Possible spelling mistake found.',
+                    'offset': word.start(),
+                    'length': len(word.group()),
+                    'replacements': [{'value': word.group().upper()}],
+                    'rule': {
+                        'id': 'MORFOLOGIK_RULE_EN_US',
+                        'category': {'id': 'TYPOS', 'name': 'Possible Typo'},
+                        'urls': [{'value': 'https://languagetool.org'}],
+                    },
+                })
+        return matches
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body):
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_body(b'[{"name": "English (US)", "code": "en", "longCode": "en-US"}]')
+
+    def do_POST(self):
+        size = int(self.headers.get('Content-Length', 0))
+        query = parse_qs(self.rfile.read(size).decode('utf-8'))
+        with self.server._lock:
+            self.server.requests += 1
+            self.server.bytes += size
+        if 'data' in query:
+            annotation = json.loads(query['data'][0])['annotation']
+            # blank markup out, keeping offsets
+            text = ''.join(part.get('text', ' ' * len(part.get('markup', '')))
+                           for part in annotation)
+        else:
+            text = query['text'][0]
+        language = query.get('language', ['auto'])[0]
+        with self.server._lock:
+            self.server.languages.append(language)
+        time.sleep(self.server.latency)
+        if self.server.body is not None:
+            self.send_body(self.server.body)
+            return
+        self.send_body(json.dumps({
+            'matches': self.server.find_matches(text),
+            'language': {
+                'code': language,
+                'name': 'English (US)',
+                'detectedLanguage': {'code': 'en-US', 'name': 'English (US)',
+                                     'confidence': 0.99},
+            },
+        }).encode('utf-8'))
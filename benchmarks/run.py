@@ -0,0 +1,222 @@
+"""
+Headless benchmarks of the plugin.
+
+Runs the plugin against a fake `sublime` module (see fake/) and a mock
+LanguageTool server (see mock_server.py), and prints timings as JSON:
+
+    python benchmarks/run.py --sizes 100,10000,100000 --output bench.json
+
+Each scenario is run for every size, given as a number of problems.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+import types
+import importlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(HERE, 'fake'))
+sys.path.insert(0, HERE)
+
+import sublime
+from mock_server import MockServer
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def load_plugin():
+    """Import the plugin modules as package `LanguageTool`."""
+    package = types.ModuleType('LanguageTool')
+    package.__path__ = [ROOT]
+    sys.modules['LanguageTool'] = package
+    with open(os.path.join(ROOT, 'LanguageTool.sublime-settings')) as f:
+        defaults = json.loads(re.sub(r'^\s*//.*$', '', f.read(), flags=re.M))
+    settings = sublime.load_settings('LanguageTool.sublime-settings')
+    for key, value in defaults.items():
+        settings.set(key, value)
+    settings.set('disk_cache', False)
+    modules = {}
+    for name in ('utils', 'ui', 'server', 'cache', 'checker', 'commands'):
+        modules[name] = importlib.import_module('LanguageTool.' + name)
+    return types.SimpleNamespace(**modules)
+
+
+def make_text(words, paragraph_words=80):
+    rng = random.Random(words)
+    paragraphs = []
+    for start in range(0, words, paragraph_words):
+        count = min(paragraph_words, words - start)
+        paragraphs.append(' '.join(rng.choice(WORDS) for _ in range(count)) + '.')
+    return '\n\n'.join(paragraphs) + '\n'
+
+
+def make_view(plugin, problems, density=0.2):
+    """Return a view holding `problems` problems, without a server."""
+    text = make_text(int(problems / density))
+    view = sublime.active_window().new_file(text)
+    matches = MockServer(density=density).find_matches(text)[:problems]
+    found = []
+    for match in matches:
+        problem = plugin.utils.parse_match(match)
+        problem.originalContent = text[problem.offset:problem.offset + problem.length]
+        problem.id = plugin.utils.new_problem_id()
+        found.append(problem)
+    plugin.utils.save_problems(view, found)
+    plugin.ui.render_highlights(view)
+    return view
+
+
+def measure(function, repeat):
+    """Return mean seconds per call of function over `repeat` calls."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_full_check(plugin, problems, server):
+    density = 0.2
+    server.density = density
+    sublime.load_settings('LanguageTool.sublime-settings').set('server', server.url)
+    view = sublime.active_window().new_file(make_text(int(problems / density)))
+    plugin.cache.get_cache().clear()
+    requests = server.requests
+    start = time.perf_counter()
+    view.run_command('language_tool')
+    sublime.run_main(timeout=600, until=lambda: not plugin.checker.is_checking(view))
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'found': len(plugin.utils.get_problems(view)),
+        'requests': server.requests - requests,
+    }
+
+
+def bench_text_changed(plugin, problems, repeat=200):
+    view = make_view(plugin, problems)
+    listener = plugin.commands.LanguageToolTextListener()
+    listener.buffer = view.buffer()
+    rng = random.Random(1)
+    total = 0.0
+    calls = view.api_calls
+    for _ in range(repeat):
+        point = rng.randrange(view.size())
+        change = view._apply(point, point, 'x')
+        start = time.perf_counter()
+        listener.on_text_changed([change])
+        total += time.perf_counter() - start
+    return {'seconds_per_op': total / repeat,
+            'api_calls_per_op': (view.api_calls - calls) / repeat}
+
+
+def bench_recompute_highlights(plugin, problems, repeat=200):
+    """Time keystrokes inside a problem, which solve it, and elsewhere."""
+    view = make_view(plugin, problems)
+    index = plugin.utils.get_problems(view)
+    rng = random.Random(2)
+    repeat = min(repeat, problems // 2)
+
+    def keystroke(point):
+        calls = view.api_calls
+        editor = view.edit_seconds
+        start = time.perf_counter()
+        view.type_text(point, 'x')
+        # the editor moving its regions along is not part of the plugin
+        seconds = time.perf_counter() - start - (view.edit_seconds - editor)
+        return seconds, view.api_calls - calls
+
+    solved = []
+    for _ in range(repeat):
+        last = next(index.before(view.size()))
+        problem = next(index.after(rng.randrange(-1, last.offset)))
+        solved.append(keystroke(problem.offset + 1))
+    plain = []
+    while len(plain) < repeat:
+        point = rng.randrange(view.size())
+        if index.at(point) is None:
+            plain.append(keystroke(point))
+    assert len(index) == problems - repeat, 'keystrokes did not solve their problem'
+    return {'solved_seconds_per_op': sum(s for s, calls in solved) / repeat,
+            'solved_api_calls_per_op': sum(calls for s, calls in solved) / repeat,
+            'plain_seconds_per_op': sum(s for s, calls in plain) / repeat,
+            'plain_api_calls_per_op': sum(calls for s, calls in plain) / repeat}
+
+
+def bench_hover(plugin, problems, repeat=1000):
+    view = make_view(plugin, problems)
+    listener = plugin.commands.LanguageToolListener()
+    rng = random.Random(3)
+    seconds = measure(lambda: listener.on_hover(view, rng.randrange(view.size()), 1), repeat)
+    return {'seconds_per_op': seconds}
+
+
+def bench_goto_next(plugin, problems, repeat=200):
+    view = make_view(plugin, problems)
+    rng = random.Random(4)
+
+    def goto_next():
+        point = rng.randrange(view.size())
+        view.sel().clear()
+        view.sel().add(sublime.Region(point, point))
+        view.run_command('goto_next_language_problem')
+
+    return {'seconds_per_op': measure(goto_next, repeat)}
+
+
+SCENARIOS = {
+    'full_check': bench_full_check,
+    'text_changed': bench_text_changed,
+    'recompute_highlights': bench_recompute_highlights,
+    'hover': bench_hover,
+    'goto_next': bench_goto_next,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='100,10000,100000',
+                        help='comma separated numbers of problems')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios to run')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mock server latency per request, in seconds')
+    parser.add_argument('--output', help='write results to this file')
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    sublime.Window()
+    server = MockServer(latency=args.latency).start()
+    results = []
+    for name in args.scenarios.split(','):
+        for size in map(int, args.sizes.split(',')):
+            if name == 'full_check':
+                result = SCENARIOS[name](plugin, size, server)
+            else:
+                result = SCENARIOS[name](plugin, size)
+            result.update(scenario=name, problems=size)
+            print(name, size, result, file=sys.stderr)
+            results.append(result)
+
+    report = json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': args.latency,
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Cache of the problems LanguageTool found in paragraphs of text.
+
+Entries are keyed by a hash of the paragraph text and the parameters of the
+request, including which parts of the text were sent as markup, so unchanged
+paragraphs can be served without contacting the server again. Problems are stored with offsets relative to their paragraph.
+
+Besides the in-memory LRU cache, entries are persisted in an SQLite database
+in Sublime's cache directory, shared by all windows and kept across sessions,
+with size-based eviction and expiry.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import sublime
+
+from .utils import Problem, count, get_settings, log
+
+_CACHE = None
+
+def get_cache():
+    global _CACHE
+    if _CACHE is None:
+        settings = get_settings()
+        disk = None
+        if settings.get('disk_cache', True):
+            path = os.path.join(sublime.cache_path(), 'LanguageTool', 'matches.sqlite')
+            disk = DiskCache(path,
+                             settings.get('disk_cache_max_bytes', 64 * 1024 * 1024),
+                             settings.get('disk_cache_ttl_days', 30) * 86400)
+        _CACHE = MatchCache(settings.get('cache_max_entries', 10000),
+                            settings.get('cache_max_bytes', 16 * 1024 * 1024),
+                            disk)
+    return _CACHE
+
+def plugin_unloaded():
+    if _CACHE is not None and _CACHE.disk is not None:
+        _CACHE.disk.close()
+
+def make_key(text, server, language, disabled_rules, markup=()):
+    """Return the cache key of a paragraph checked with given parameters.
+
+    Args:
+      markup (list): (start, end) ranges of the paragraph sent as markup
+        (see checker.Chunk.annotate), relative to it. Empty if it was sent
+        as plain text.
+    """
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    if markup:
+        markup = hashlib.sha1(json.dumps(markup).encode('utf-8')).hexdigest()
+    return (digest, server, language, ','.join(sorted(disabled_rules)), markup or '')
+
+def estimate_size(problems):
+    """Roughly estimate memory used by a list of problems, in bytes."""
+    size = 100
+    for problem in problems:
+        size += 400 + len(problem.message)
+        size += sum(len(r) + 50 for r in problem.replacements)
+    return size
+
+
+class MatchCache:
+    """LRU cache bounded both in number of entries and in estimated bytes."""
+
+    def __init__(self, max_entries, max_bytes, disk=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (problems, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return a copy of the problems cached under key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                count('cache.memory_misses')
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            count('cache.memory_hits')
+            return [problem.copy() for problem in entry[0]]
+
+    def prefetch(self, keys):
+        """Load entries missing from memory from the disk cache.
+
+        Queries the database: call it off the main thread.
+
+        Returns:
+          dict: problems loaded from disk, by key.
+        """
+        if self.disk is None:
+            return {}
+        with self._lock:
+            missing = [key for key in keys if key not in self._entries]
+        found = self.disk.get_many(missing)
+        count('cache.disk_hits', len(found))
+        count('cache.disk_misses', len(missing) - len(found))
+        for key, problems in found.items():
+            self._store(key, problems)
+        return found
+
+    def put(self, key, problems):
+        self.put_many([(key, problems)])
+
+    def put_many(self, items):
+        """Cache problems of several paragraphs, given as (key, problems)."""
+        # callers keep using their problems, the disk cache is written later
+        items = [(key, [problem.copy() for problem in problems])
+                 for key, problems in items]
+        for key, problems in items:
+            self._store(key, problems)
+        if self.disk is not None and items:
+            sublime.set_timeout_async(lambda: self.disk.put_many(items))
+
+    def _store(self, key, problems):
+        size = estimate_size(problems)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = ([problem.copy() for problem in problems], size)
+            self.size += size
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or self.size > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            log("Cache", "cleared")
+
+
+_FIELDS = ('offset', 'length', 'rule', 'category', 'message', 'replacements', 'urls')
+
+def serialize(problems):
+    """Encode problems compactly, as compressed JSON rows."""
+    rows = [[getattr(problem, field) for field in _FIELDS] for problem in problems]
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode('utf-8'))
+
+def deserialize(data):
+    rows = json.loads(zlib.decompress(data).decode('utf-8'))
+    return [Problem(*row) for row in rows]
+
+
+class DiskCache:
+    """Persistent cache of problems in an SQLite database.
+
+    The database is opened in WAL mode with a busy timeout, so several
+    windows or editor instances can use it at once. Entries expire `ttl`
+    seconds after being stored, and the least recently used ones are evicted
+    once the database holds more than `max_bytes` of serialized problems.
+    Reads only note which entries they found: access times are written in
+    batch with the next write.
+
+    Lookups and writes block on the database, and run off the main thread.
+    """
+
+    BATCH = 500
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._connection = None
+        self._disabled = False
+        self._accessed = set()  # hashed keys read since the last write
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None and not self._disabled:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                connection = sqlite3.connect(self.path, timeout=10,
+                                             check_same_thread=False)
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS matches ('
+                    ' key TEXT PRIMARY KEY, value BLOB, size INTEGER,'
+                    ' created REAL, accessed REAL)')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS matches_accessed ON matches (accessed)')
+                connection.execute('DELETE FROM matches WHERE created < ?',
+                                   (time.time() - self.ttl,))
+                connection.commit()
+                self._connection = connection
+            except sqlite3.Error as e:
+                log("DiskCache", "Error: disabling disk cache:", e)
+                self._disabled = True
+        return self._connection
+
+    @staticmethod
+    def _key(key):
+        return hashlib.sha1('\x1f'.join(key).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """Return a dict of problems cached under keys, skipping missing ones."""
+        result = {}
+        with self._lock:
+            connection = self._connect()
+            if connection is None or not keys:
+                return result
+            by_hash = {self._key(key): key for key in keys}
+            hashes = list(by_hash)
+            now = time.time()
+            try:
+                for start in range(0, len(hashes), self.BATCH):
+                    batch = hashes[start:start + self.BATCH]
+                    rows = connection.execute(
+                        'SELECT key, value FROM matches WHERE created >= ? AND key IN (%s)'
+                        % ','.join('?' * len(batch)), [now - self.ttl] + batch).fetchall()
+                    for hashed, value in rows:
+                        result[by_hash[hashed]] = deserialize(value)
+                        self._accessed.add(hashed)
+            except sqlite3.Error as e:
+                log("DiskCache", "Error:", e)
+        log("DiskCache", "loaded", len(result), "of", len(keys), "entries")
+        return result
+
+    def put_many(self, items):
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return
+            now = time.time()
+            rows = []
+            for key, problems in items:
+                value = serialize(problems)
+                rows.append((self._key(key), value, len(value), now, now))
+            try:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?)', rows)
+                self._touch(connection, now)
+                self._evict(connection)
+                connection.commit()
+            except sqlite3.Error as e:
+                log("DiskCache", "Error:", e)
+
+    def _touch(self, connection, now):
+        """Write access times of the entries read since the last write."""
+        if self._accessed:
+            connection.executemany('UPDATE matches SET accessed = ? WHERE key = ?',
+                                   [(now, hashed) for hashed in self._accessed])
+            self._accessed.clear()
+
+    def _evict(self, connection):
+        total, entries = connection.execute(
+            'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM matches').fetchone()
+        if total > self.max_bytes and entries:
+            # drop least recently used entries, down to 90% of the budget
+            excess = int(entries * (1 - 0.9 * self.max_bytes / total)) + 1
+            connection.execute(
+                'DELETE FROM matches WHERE key IN'
+                ' (SELECT key FROM matches ORDER BY accessed LIMIT ?)', (excess,))
+            log("DiskCache", "evicted", excess, "entries")
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                try:
+                    self._touch(self._connection, time.time())
+                    self._connection.commit()
+                except sqlite3.Error as e:
+                    log("DiskCache", "Error:", e)
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,561 @@
+"""
+Background check pipeline.
+
+Checks run off Sublime's main thread so that the editor never blocks on the
+server round trip. The checked text is split at paragraph boundaries into
+size-bounded chunks, which are queued in the request scheduler (see
+server.Scheduler); problems are added to the view as each chunk completes.
+With `viewport_first`, chunks are prioritized by their distance to the
+visible region, and re-prioritized as the view scrolls. Problems found
+in each paragraph are cached, so that only paragraphs which changed since
+they were last checked are sent again; paragraphs missing from memory are
+looked up in the disk cache off the main thread.
+
+Every view has at most one current check: starting a new one supersedes the
+older, whose pending chunks are cancelled and whose late results are dropped.
+Checks are tagged with the change count of their view when they start, and
+edits made while they are in flight are logged, so that the offsets of
+results are moved through these edits; results overlapping edited text are
+dropped.
+
+To bound memory, once views hold more than `max_retained_problems` problems,
+those of the least recently activated background views are dropped; such
+views are checked again when activated, which the cache mostly serves.
+
+In live mode (`check_as_you_type`), edits of a view which was checked before
+are recorded as dirty ranges; once typing stops for `check_delay`
+milliseconds, the paragraphs around them are re-checked and their problems
+replaced, leaving the rest of the view untouched.
+"""
+
+import bisect
+import sublime
+
+from .utils import *
+from .ui import *
+from . import server
+from . import local_server
+from .cache import get_cache, make_key
+
+_CHECKS = view_state({})
+_LIVE_VIEWS = view_state(set())
+_DIRTY = view_state({})
+_DEBOUNCE = view_state({})
+_SHED_VIEWS = view_state(set())  # views whose problems were dropped
+
+def cancel_check(view):
+    """Cancel any in-flight check of view."""
+    check = _CHECKS.pop(view.id(), None)
+    if check:
+        check.cancel()
+
+def is_checking(view):
+    return view.id() in _CHECKS
+
+def check_view(view, regions):
+    """Check text of `regions` in the background.
+
+    Problems are saved and highlighted on the main thread as chunks come back
+    from the server, unless a newer check of the same view was started
+    meanwhile.
+    """
+    check = Check(view, regions, *get_check_parameters(view))
+    check.start()
+    return check
+
+def get_check_parameters(view):
+    """Return (server_url, language, ignored_ids, pool) to check view with.
+
+    `language` is the language set for view, possibly `auto`: results are
+    cached under it even when a detected language is sent instead (see
+    Check.get_request_language), so that pinning it does not make them miss.
+    """
+    pool = local_server.get_pool()
+    server_url = pool.name if pool else get_settings().get('server')
+    language = view.settings().get('language_tool_language', 'auto')
+    ignored_ids = [rule['id'] for rule in load_ignored_rules()]
+    return server_url, language, ignored_ids, pool
+
+def get_open_views():
+    """Return open views by id."""
+    return {view.id(): view for window in sublime.windows() for view in window.views()}
+
+def shed_problems():
+    """Drop problems of background views beyond the problem budget."""
+    keep = {window.active_view().id() for window in sublime.windows()
+            if window.active_view()}
+    views = get_open_views()
+    for view_id in select_shed_views(keep):
+        view = views.get(view_id)
+        if view is None:
+            forget_view(view_id)
+            continue
+        log("Check", "dropping problems of background view", view_id)
+        count('views.shed')
+        cancel_check(view)
+        enable_live_check(view, False)
+        erase_highlights(view)
+        save_problems(view, [])
+        save_hidden_problems(view, [])
+        _SHED_VIEWS.add(view_id)
+
+def restore_view(view):
+    """Check again a view whose problems were dropped, now activated."""
+    if view.id() in _SHED_VIEWS:
+        _SHED_VIEWS.discard(view.id())
+        index_ignored_ranges(view)
+        enable_live_check(view)
+        check_view(view, [sublime.Region(0, view.size())])
+
+def format_problem_counts(results=(0, 0)):
+    """Return a plain text report of problems retained by each view.
+
+    Args:
+      results (tuple): (files, problems) of project results waiting for
+        their view (see project.count_results).
+    """
+    views = get_open_views()
+    lines = []
+    total = 0
+    for view_id, view in views.items():
+        problems = len(get_problems(view))
+        hidden = len(get_hidden_problems(view))
+        if problems or hidden or view_id in _SHED_VIEWS:
+            name = view.file_name() or view.name() or 'untitled (view %d)' % view_id
+            lines.append('%8d %8d  %s%s' % (problems, hidden, name,
+                                            ' (dropped)' if view_id in _SHED_VIEWS else ''))
+            total += problems + hidden
+    lines.sort()
+    lines.insert(0, '%8s %8s  %s' % ('problems', 'hidden', 'view'))
+    files, problems = results
+    if files:
+        lines.append('%8d %8s  project results of %d files' % (problems, '', files))
+        total += problems
+    lines.append('')
+    lines.append('%d problems retained, budget %d'
+                 % (total, get_settings().get('max_retained_problems', 100000)))
+    return '\n'.join(lines) + '\n'
+
+def record_edit(view, a, b, inserted):
+    """Log that text [a, b) of view was replaced, for its check in flight."""
+    check = _CHECKS.get(view.id())
+    if check:
+        check.edits.append((view.change_count(), a, b, inserted))
+
+def prioritize_check(view):
+    """Re-prioritize pending chunks of the check of view, if any."""
+    check = _CHECKS.get(view.id())
+    if check:
+        check.prioritize()
+
+def get_distance(region, visible):
+    """Return the number of characters between region and visible region."""
+    if region.intersects(visible):
+        return 0
+    if region.end() <= visible.begin():
+        return visible.begin() - region.end() + 1
+    return region.begin() - visible.end() + 1
+
+def enable_live_check(view, enabled=True):
+    """Allow or forbid checking view as the user types."""
+    if enabled:
+        _LIVE_VIEWS.add(view.id())
+    else:
+        _LIVE_VIEWS.discard(view.id())
+        _DIRTY.pop(view.id(), None)
+
+def mark_dirty(view, a, b, inserted):
+    """Record that text [a, b) of view was replaced by `inserted` characters.
+
+    Dirty ranges are kept sorted and coalesced, and shifted by later edits.
+    Does nothing unless live mode is enabled for view.
+    """
+    view_id = view.id()
+    if view_id not in _LIVE_VIEWS or not get_settings().get('check_as_you_type'):
+        return
+    _DIRTY[view_id] = merge_edit(_DIRTY.get(view_id, []), a, b, inserted)
+    schedule_live_check(view)
+
+def schedule_live_check(view):
+    """(Re)start the idle timer after which dirty ranges of view are checked."""
+    view_id = view.id()
+    token = _DEBOUNCE.get(view_id, 0) + 1
+    _DEBOUNCE[view_id] = token
+    delay = get_settings().get('check_delay', 1000)
+    sublime.set_timeout(lambda: run_live_check(view, token), delay)
+
+def run_live_check(view, token):
+    view_id = view.id()
+    if _DEBOUNCE.get(view_id) != token or view_id not in _DIRTY:
+        return
+    if is_checking(view):
+        # Wait for the running check rather than superseding it
+        schedule_live_check(view)
+        return
+
+    regions = []
+    for start, end in _DIRTY.pop(view_id):
+        region = paragraph_region(view, sublime.Region(start, min(end, view.size())))
+        if regions and regions[-1].end() >= region.begin():
+            regions[-1] = regions[-1].cover(region)
+        else:
+            regions.append(region)
+    log("LiveCheck", "checking", regions)
+
+    discard_problems(view, regions)
+    check_view(view, regions)
+
+
+def get_markup(ignored, offset, text):
+    """Return ignored ranges of text at offset, relative to it."""
+    return [(start - offset, end - offset)
+            for start, end in ignored.within(offset, offset + len(text))]
+
+
+class Chunk:
+    """Text sent in a single request, made of one or more buffer segments.
+
+    Segments which are not adjacent in the buffer are joined by a blank line,
+    so that no match can span both of them.
+    """
+
+    SEPARATOR = '\n\n'
+
+    def __init__(self, segments, keys):
+        self.segments = segments
+        self.keys = keys  # cache key of each segment
+        self._starts = []  # chunk offset of each segment
+        parts = []
+        position = 0
+        end = None
+        for offset, text in segments:
+            if end is not None and offset != end:
+                parts.append(self.SEPARATOR)
+                position += len(self.SEPARATOR)
+            self._starts.append(position)
+            parts.append(text)
+            position += len(text)
+            end = offset + len(text)
+        self.text = ''.join(parts)
+        self.region = sublime.Region(segments[0][0], end)
+        self.annotation = None
+        self.detected_language = None
+
+    def annotate(self, markup):
+        """Mark text of the chunk lying in ignored ranges as markup.
+
+        Args:
+          markup (list): (start, end) ranges of each segment to send as
+            markup, relative to the segment (see get_markup).
+        """
+        annotation = []
+        end = None
+        for (offset, text), ranges in zip(self.segments, markup):
+            if end is not None and offset != end:
+                annotation.append({'text': self.SEPARATOR})
+            position = 0
+            for start, stop in ranges:
+                if start > position:
+                    annotation.append({'text': text[position:start]})
+                part = {'markup': text[start:stop]}
+                if '\n' in part['markup']:
+                    # keep text on both sides in separate paragraphs
+                    part['interpretAs'] = '\n\n'
+                annotation.append(part)
+                position = stop
+            end = offset + len(text)
+            if position < len(text):
+                annotation.append({'text': text[position:]})
+        if any('markup' in part for part in annotation):
+            self.annotation = annotation
+
+    def locate(self, offset, length):
+        """Find the segment containing text at a chunk offset.
+
+        Returns:
+          tuple: (segment index, offset relative to the segment), or None if
+          the text does not lie within a single segment.
+        """
+        index = bisect.bisect_right(self._starts, offset) - 1
+        if index < 0:
+            return None
+        local = offset - self._starts[index]
+        if local + length > len(self.segments[index][1]):
+            return None
+        return index, local
+
+    def parse(self, future):
+        """Split problems of the response to the chunk among its segments.
+
+        Runs in the thread which received the response. Problems of each
+        segment are also cached, under its key.
+
+        Returns:
+          list: problems of each segment, or None if the request failed.
+        """
+        if future.exception():
+            log("Check", "Error:", future.exception())
+            return None
+        result = future.result()
+        if not result:
+            return None
+        log("Matches", result['matches'])
+        self.detected_language = result.get('language', {}).get('detectedLanguage')
+
+        found = [[] for segment in self.segments]
+        with timed('check.parse'):
+            for problem in result['matches']:
+                location = self.locate(problem.offset, problem.length)
+                if location is not None:
+                    # coalesced requests share their response
+                    problem = problem.copy()
+                    index, problem.offset = location
+                    found[index].append(problem)
+        with timed('cache.store'):
+            get_cache().put_many(list(zip(self.keys, found)))
+        return found
+
+
+class Check:
+    """A check of view regions, split in chunks."""
+
+    def __init__(self, view, regions, server_url, language, ignored_ids, pool=None):
+        self.view = view
+        self.regions = regions
+        self.server_url = server_url
+        self.pool = pool
+        self.language = language
+        self.ignored_ids = ignored_ids
+        self.chunks = []
+        self.futures = []
+        self.visible = None
+        self.done = 0
+        self.failed = 0
+        self.change_count = view.change_count()
+        self.edits = []  # (change count, a, b, inserted) since the check started
+
+    def is_current(self):
+        return _CHECKS.get(self.view.id()) is self
+
+    def start(self):
+        cancel_check(self.view)
+        _CHECKS[self.view.id()] = self
+
+        max_size = get_settings().get('max_chunk_size', 20000)
+        cache = get_cache()
+        pieces = []
+        for region in self.regions:
+            with timed('check.substr'):
+                text = self.view.substr(region)
+            with timed('check.split'):
+                for offset, piece in split_paragraphs(text, max_size):
+                    pieces.append((region.begin() + offset, piece))
+
+        ignored = get_ignored_ranges(self.view)
+        annotate = ignored is not None and get_settings().get('annotate_markup', True)
+
+        cached = []
+        dirty = []  # (offset, text, cache key, markup) of paragraphs to send
+        with timed('cache.lookup'):
+            for offset, piece in pieces:
+                markup = get_markup(ignored, offset, piece) if annotate else ()
+                key = self.cache_key(piece, markup)
+                problems = cache.get(key)
+                if problems is None:
+                    dirty.append((offset, piece, key, markup))
+                else:
+                    cached.extend(self.make_problems(offset, problems))
+        self.add(cached)
+
+        if dirty and cache.disk is not None:
+            # The database may be slow, or locked by another window
+            sublime.set_timeout_async(lambda: self.load(dirty))
+            show_progress(self.view, self.status)
+        else:
+            self.send(dirty)
+
+    def load(self, dirty):
+        """Look paragraphs up in the disk cache (runs off the main thread)."""
+        if not self.is_current():
+            return
+        found = get_cache().prefetch([key for offset, piece, key, markup in dirty])
+        sublime.set_timeout(lambda: self.resume(dirty, found))
+
+    def resume(self, dirty, found):
+        """Add problems found on disk, and send the other paragraphs."""
+        if not self.is_current():
+            return
+        cached = []
+        for offset, piece, key, markup in dirty:
+            if key in found:
+                cached.extend(self.make_problems(offset, found[key]))
+        self.add(cached)
+        self.send([entry for entry in dirty if entry[2] not in found])
+
+    def add(self, problems):
+        if problems:
+            with timed('check.add'):
+                blocks = add_problems(self.view, problems)
+            render_highlights(self.view, blocks)
+            shed_problems()
+
+    def send(self, dirty):
+        """Queue chunks of the paragraphs missing from the cache."""
+        max_size = get_settings().get('max_chunk_size', 20000)
+        entries = {offset: (key, markup) for offset, piece, key, markup in dirty}
+        with timed('check.split'):
+            self.chunks = [Chunk(batch, [entries[offset][0] for offset, piece in batch])
+                           for batch in pack_pieces([entry[:2] for entry in dirty],
+                                                    max_size)]
+        cache = get_cache()
+        log("Check", "sending", len(dirty), "paragraphs in", len(self.chunks),
+            "chunks,", "cached:", cache.hits, "hits /", cache.misses, "misses")
+
+        if not self.chunks:
+            self.finish()
+            return
+
+        scheduler = server.get_scheduler()
+        self.visible = self.view.visible_region()
+        language = self.get_request_language()
+        for chunk in self.chunks:
+            markup = [entries[offset][1] for offset, piece in chunk.segments]
+            if any(markup):
+                with timed('check.annotate'):
+                    chunk.annotate(markup)
+            priority = self.get_priority(chunk)
+            future = scheduler.submit(self.pool or self.server_url, chunk.text,
+                                      language, self.ignored_ids, priority,
+                                      chunk.annotation)
+            future.add_done_callback(
+                lambda future, chunk=chunk: self.parse(chunk, future))
+            self.futures.append(future)
+        show_progress(self.view, self.status)
+
+    def get_request_language(self):
+        """Return the language to send: in auto mode, the one pinned for the view."""
+        if self.language == 'auto':
+            # don't detect the language of every chunk again
+            return (get_detected_language(self.view) or (self.language,))[0]
+        return self.language
+
+    def get_priority(self, chunk):
+        if get_settings().get('viewport_first', True):
+            return get_distance(chunk.region, self.visible)
+        return 0
+
+    def prioritize(self):
+        """Update priorities of pending chunks after the view scrolled."""
+        visible = self.view.visible_region()
+        if visible == self.visible:
+            return
+        self.visible = visible
+        chunks = dict(zip(self.futures, self.chunks))
+
+        def get_priority(request):
+            priorities = [self.get_priority(chunks[waiter])
+                          for waiter in request.waiters if waiter in chunks]
+            if priorities:
+                return min(priorities)
+
+        server.get_scheduler().reprioritize(get_priority)
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+    def status(self):
+        if self.is_current():
+            status = 'LanguageTool: checking %d/%d' % (self.done, len(self.chunks))
+            scheduler = server.get_scheduler()
+            queued = scheduler.queue_depth()
+            if queued:
+                status += ' (%d queued, ~%ds)' % (queued, scheduler.expected_wait())
+            return status
+
+    def cache_key(self, text, markup=()):
+        return make_key(text, self.server_url, self.language, self.ignored_ids, markup)
+
+    def parse(self, chunk, future):
+        """Parse the response to chunk off the main thread, then receive it."""
+        if future.cancelled() or not self.is_current():
+            log("Check", "dropping results of superseded check")
+            return
+        try:
+            found = chunk.parse(future)
+        except Exception as e:
+            # errors of done callbacks are swallowed: the check would never end
+            log("Check", "Error:", e)
+            found = None
+        sublime.set_timeout(lambda: self.receive(chunk, found))
+
+    def receive(self, chunk, found):
+        """Add problems found in chunk to the view (runs on the main thread).
+
+        Args:
+          found (list): problems of each segment of chunk, or None if the
+            request failed.
+        """
+        if not self.is_current():
+            log("Check", "dropping results of superseded check")
+            return
+        self.done += 1
+
+        if found is None:
+            self.failed += 1
+        else:
+            if self.language == 'auto' and get_detected_language(self.view) is None:
+                detect_language(self.view, chunk.detected_language)
+                pinned = get_detected_language(self.view)
+                if pinned:
+                    # send chunks still queued in the pinned language too
+                    server.get_scheduler().retag(self.futures, pinned[0])
+            problems = []
+            with timed('check.filter'):
+                for (offset, text), segment_problems in zip(chunk.segments, found):
+                    problems.extend(self.make_problems(offset, segment_problems))
+            with timed('check.add'):
+                blocks = add_problems(self.view, problems)
+            render_highlights(self.view, blocks)
+            shed_problems()
+
+        if self.done == len(self.chunks):
+            self.finish()
+
+    def make_problems(self, offset, problems):
+        """Turn problems relative to a segment at offset into view problems."""
+        result = []
+        for problem in problems:
+            shift_offset(problem, offset)
+            inside = any(region_contains(region, problem) for region in self.regions)
+            if inside and self.remap(problem) and not is_ignored(self.view, problem.offset):
+                problem.originalContent = self.view.substr(get_region_for_problem(problem))
+                problem.id = new_problem_id()
+                result.append(problem)
+        return result
+
+    def remap(self, problem):
+        """Move problem through the edits made since the check started.
+
+        Returns:
+          bool: False if the problem overlaps edited text, and must be dropped.
+        """
+        start = problem.offset
+        end = start + problem.length
+        for change_count, a, b, inserted in self.edits:
+            if change_count <= self.change_count or end <= a:
+                continue  # made before the check read the text, or after problem
+            if start < b:
+                count('check.stale_problems')
+                return False
+            delta = inserted - (b - a)
+            start += delta
+            end += delta
+        problem.offset = start
+        return True
+
+    def finish(self):
+        if self.is_current():
+            del _CHECKS[self.view.id()]
+        if self.failed:
+            set_status_bar('Could not parse server response')
@@ -7,13 +7,13 @@ content to LanguageTool (via http) and highlights reported problems.
 
 import sublime
 import sublime_plugin
-# import subprocess
-# import os.path
 
 from .utils import *
 from .ui import *
 from .languages import LANGUAGES
-from . import server
+from . import checker
+from . import project
+from . import local_server
 
 class setLanguageToolPanelTextCommand(sublime_plugin.TextCommand):
     def run(self, edit, str):
@@ -32,17 +32,13 @@ class gotoNextLanguageProblemCommand(sublime_plugin.TextCommand):
         if len(problems) > 0:
             sel = self.view.sel()[0]
             if jump_forward:
-                for p in problems:
-                    r = self.view.get_regions(p['regionKey'])[0]
-                    if (not is_problem_solved(self.view, p)) and (sel.begin() < r.a):
-                        select_problem(self.view, p)
-                        return
+                candidates = problems.after(sel.begin())
             else:
-                for p in reversed(problems):
-                    r = self.view.get_regions(p['regionKey'])[0]
-                    if (not is_problem_solved(self.view, p)) and (r.a < sel.begin()):
-                        select_problem(self.view, p)
-                        return
+                candidates = problems.before(sel.begin())
+            for p in candidates:
+                if not is_problem_solved(self.view, p):
+                    select_problem(self.view, p)
+                    return
         set_status_bar("no further language problems to fix")
         sublime.active_window().run_command("hide_panel", {
             "panel": "output.languagetool"
@@ -53,10 +49,12 @@ class clearLanguageProblemsCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         problems = get_problems(self.view)
         log("Clearing", len(problems), "problems")
-        for p in problems:
-            self.view.erase_regions(p['id'])
+        checker.cancel_check(self.view)
+        checker.enable_live_check(self.view, False)
+        erase_highlights(self.view)
         problems = []
         save_problems(self.view, problems)
+        save_hidden_problems(self.view, [])
 
 
 class markLanguageProblemSolvedCommand(sublime_plugin.TextCommand):
@@ -66,196 +64,248 @@ class markLanguageProblemSolvedCommand(sublime_plugin.TextCommand):
         selected_region = self.view.sel()[0]
 
         # Find problem corresponding to selection
-        for problem in problems:
-            problem_region = self.view.get_regions(problem['regionKey'])[0]
-            if problem_region == selected_region:
-                break
-        else:
+        problem = problems.at(selected_region.begin())
+        if problem is None or get_region_for_problem(problem) != selected_region:
             set_status_bar('no language problem selected')
             return
+        problem_region = get_region_for_problem(problem)
 
         next_caret_pos = problem_region.a
-        replacements = problem['replacements']
+        replacements = problem.replacements
 
         if apply_fix and replacements:
             # fix selected problem:
             correct_problem(self.view, edit, problem, replacements)
 
         else:
-            # ignore problem:
-            equal_problems = get_equal_problems(problems, problem)
-            for p2 in equal_problems:
-                ignore_problem(p2, self.view, edit)
+            # ignore problem and all equal ones:
+            ignore_problems(self.view, get_equal_problems(problems, problem))
             # After ignoring problem:
             move_caret(self.view, next_caret_pos, next_caret_pos)  # advance caret
             self.view.run_command("goto_next_language_problem")
 
-# class startLanguageToolServerCommand(sublime_plugin.TextCommand):
-#     """Launch local LanguageTool Server."""
+class applyLanguageToolFixesCommand(sublime_plugin.TextCommand):
+    """Apply every fix which has exactly one suggested replacement.
+
+    Fixes are applied from the end of the view backwards in a single edit,
+    so that offsets of the remaining ones stay valid, and a single undo
+    reverts all of them.
+    """
+
+    def run(self, edit, rule=None, category=None):
+        fixes = []
+        end = None
+        for problem in reversed(get_problems(self.view)):
+            if len(problem.replacements) != 1:
+                continue
+            if rule is not None and problem.rule != rule:
+                continue
+            if category is not None and problem.category != category:
+                continue
+            region = get_region_for_problem(problem)
+            if (end is not None and region.end() > end) or is_problem_solved(self.view, problem):
+                continue  # overlaps a fix applied after it
+            fixes.append(problem)
+            end = region.begin()
+
+        # forget fixed problems first, so that the edit does not revisit them
+        remove_problems(self.view, fixes)
+        for problem in fixes:
+            self.view.replace(edit, get_region_for_problem(problem), problem.replacements[0])
+        set_status_bar('applied %d fixes' % len(fixes))
+
+
+class startLanguageToolServerCommand(sublime_plugin.TextCommand):
+    """Launch local LanguageTool Server."""
+
+    def run(self, edit):
+        try:
+            pool = local_server.start_pool()
+        except ValueError as e:
+            show_panel_text(str(e))
+            return
+        sublime.status_message('Starting local LanguageTool server (%d instances) ...'
+                               % len(pool.instances))
+
 
-#     def run(self, edit):
+class stopLanguageToolServerCommand(sublime_plugin.TextCommand):
+    """Stop local LanguageTool Server."""
 
-#         jar_path = get_settings().get('languagetool_jar')
+    def is_enabled(self):
+        return local_server.get_pool() is not None
 
-#         if not jar_path:
-#             show_panel_text("Setting languagetool_jar is undefined")
-#             return
+    def run(self, edit):
+        local_server.stop_pool()
+        sublime.status_message('Stopped local LanguageTool server')
 
-#         if not os.path.isfile(jar_path):
-#             show_panel_text(
-#                 'Error, could not find LanguageTool\'s JAR file (%s)'
-#                 '\n\n'
-#                 'Please install LT in this directory'
-#                 ' or modify the `languagetool_jar` setting.' % jar_path)
-#             return
 
-#         sublime.status_message('Starting local LanguageTool server ...')
+class showLanguageToolDiagnosticsCommand(sublime_plugin.TextCommand):
+    def run(self, edit, reset=False):
+        show_panel_text(format_diagnostics())
+        if reset:
+            reset_diagnostics()
 
-#         cmd = ['java', '-cp', jar_path, 'org.languagetool.server.HTTPServer', '--port', '8081']
 
-#         if sublime.platform() == "windows":
-#             p = subprocess.Popen(
-#                 cmd,
-#                 stdin=subprocess.PIPE,
-#                 stdout=subprocess.PIPE,
-#                 stderr=subprocess.PIPE,
-#                 shell=True,
-#                 creationflags=subprocess.SW_HIDE)
-#         else:
-#             p = subprocess.Popen(
-#                 cmd,
-#                 stdin=subprocess.PIPE,
-#                 stdout=subprocess.PIPE,
-#                 stderr=subprocess.PIPE)
+class checkLanguageToolProjectCommand(sublime_plugin.WindowCommand):
+    def run(self, folders=False):
+        if self.window.active_view() is None:
+            set_status_bar('no view to take the language from')
+            return
+        project.check_project(self.window, folders)
+
+
+class showLanguageToolProblemCountsCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        show_panel_text(checker.format_problem_counts(project.count_results()))
 
 
 class changeLanguageToolLanguageCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         self.view.languages = LANGUAGES
         languageNames = [x[0] for x in self.view.languages]
+        detected = get_detected_language(self.view)
+        if detected:
+            languageNames[0] += ' (detected: %s)' % detected[1]
+        current = self.view.settings().get('language_tool_language', 'auto')
+        selected = next((i for i, language in enumerate(self.view.languages)
+                         if language[1] == current), 0)
         handler = lambda ind: handle_language_selection(ind, self.view)
-        self.view.window().show_quick_panel(languageNames, handler)
+        self.view.window().show_quick_panel(languageNames, handler,
+                                            selected_index=selected)
 
 class LanguageToolCommand(sublime_plugin.TextCommand):
     def run(self, edit, force_server=None):
+        # Selections are checked together, in as few requests as their size
+        # allows; problems found outside of them are kept
+        regions = []
+        for selection in sorted(self.view.sel(), key=lambda region: region.begin()):
+            if selection.empty():
+                continue
+            selection = sublime.Region(selection.begin(), selection.end())
+            if regions and regions[-1].end() >= selection.begin():
+                regions[-1] = regions[-1].cover(selection)
+            else:
+                regions.append(selection)
 
-        settings = get_settings()
-        server_url = settings.get('server')
-        # highlight_scope = settings.get('highlight-scope')
-
-        selection = self.view.sel()[0] if self.view.sel() else None # first selection (ignore rest)
-        everything = sublime.Region(0, self.view.size())
-        check_region = everything if selection is None or selection.empty() else selection
-        check_text = self.view.substr(check_region)
-
-        self.view.run_command("clear_language_problems")
-
-        language = self.view.settings().get('language_tool_language', 'auto')
-        ignored_ids = [rule['id'] for rule in load_ignored_rules()]
+        if regions:
+            checker.cancel_check(self.view)
+            discard_problems(self.view, regions)
+        else:
+            regions = [sublime.Region(0, self.view.size())]
+            self.view.run_command("clear_language_problems")
 
-        matches = server.getResponse(server_url, check_text, language,
-                                       ignored_ids)
-        log("Matches", matches)
+        index_ignored_ranges(self.view)
+        checker.enable_live_check(self.view)
+        with timed('command.check'):
+            checker.check_view(self.view, regions)
 
-        if matches == None:
-            set_status_bar('Could not parse server response')
+class DeactivateRuleCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        problem = get_problems(self.view).at(self.view.sel()[0].begin())
+        if problem is None:
+            set_status_bar('select a problem to deactivate its rule')
             return
+        ignored = load_ignored_rules()
+        if all(rule['id'] != problem.rule for rule in ignored):
+            ignored.append({
+                "id": problem.rule,
+                "description": problem.message
+            })
+            save_ignored_rules(ignored)
+        deactivate_rule_problems(problem.rule)
+        self.view.run_command("goto_next_language_problem")
+        set_status_bar('deactivated rule %s' % problem.rule)
+
+
+class ActivateRuleCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        ignored = load_ignored_rules()
+        if ignored:
+            activate_callback_wrapper = lambda i: self.activate_callback(i)
+            ruleList = [[rule['id'], rule['description']] for rule in ignored]
+            self.view.window().show_quick_panel(ruleList,
+                                                activate_callback_wrapper)
+        else:
+            set_status_bar('there are no ignored rules')
 
-        shifter = lambda problem: shift_offset(problem, check_region.a)
-        get_problem = compose(shifter, parse_match)
-
-        problems = [problem for problem in map(get_problem, matches)
-                    if region_contains(check_region, problem) and not is_ignored(self.view, problem['offset'])]
-
-        for index, problem in enumerate(problems):
-            problem['originalContent'] = self.view.substr(get_region_for_problem(problem))
-            problem['id'] = str(index)
-
-        save_problems(self.view, problems)
-        recompute_highlights(self.view)
-
-# class DeactivateRuleCommand(sublime_plugin.TextCommand):
-#     def run(self, edit):
-#         ignored = load_ignored_rules()
-#         problems = get_problems(self.view)
-#         sel = self.view.sel()[0]
-#         selected = [
-#             p for p in problems
-#             if sel.contains(self.view.get_regions(p['regionKey'])[0])
-#         ]
-#         if not selected:
-#             set_status_bar('select a problem to deactivate its rule')
-#         elif len(selected) == 1:
-#             rule = {
-#                 "id": selected[0]['rule'],
-#                 "description": selected[0]['message']
-#             }
-#             ignored.append(rule)
-#             ignoredProblems = [p for p in problems if p['rule'] == rule['id']]
-#             for p in ignoredProblems:
-#                 ignore_problem(p, self.view, edit)
-#             problems = [p for p in problems if p['rule'] != rule['id']]
-#             self.view.run_command("goto_next_language_problem")
-#             save_ignored_rules(ignored)
-#             set_status_bar('deactivated rule %s' % rule)
-#         else:
-#             set_status_bar('there are multiple selected problems;'
-#                            ' select only one to deactivate')
-
-
-# class ActivateRuleCommand(sublime_plugin.TextCommand):
-#     def run(self, edit):
-#         ignored = load_ignored_rules()
-#         if ignored:
-#             activate_callback_wrapper = lambda i: self.activate_callback(i)
-#             ruleList = [[rule['id'], rule['description']] for rule in ignored]
-#             self.view.window().show_quick_panel(ruleList,
-#                                                 activate_callback_wrapper)
-#         else:
-#             set_status_bar('there are no ignored rules')
-
-#     def activate_callback(self, i):
-#         ignored = load_ignored_rules()
-#         if i != -1:
-#             activate_rule = ignored[i]
-#             ignored.remove(activate_rule)
-#             save_ignored_rules(ignored)
-#             set_status_bar('activated rule %s' % activate_rule['id'])
+    def activate_callback(self, i):
+        ignored = load_ignored_rules()
+        if i != -1:
+            activate_rule = ignored[i]
+            ignored.remove(activate_rule)
+            save_ignored_rules(ignored)
+            # problems found before the rule was deactivated are restored,
+            # new text is only checked for it by the next check
+            activate_rule_problems(activate_rule['id'])
+            set_status_bar('activated rule %s' % activate_rule['id'])
 
 
 class LanguageToolTextListener(sublime_plugin.TextChangeListener):
+    @timed('listener.text_changed')
     def on_text_changed(self, changes):
-        for change in changes:
-            view = sublime.active_window().active_view()
+        for view in self.buffer.views():
             problems = get_problems(view)
-            if problems:
-                offset = len(change.str)-change.len_utf8
-                log("TextChange", change, offset)
+            hidden = get_hidden_problems(view)
+            edited = []
+            for change in changes:
+                removed = change.b.pt - change.a.pt
+                inserted = len(change.str)
+                checker.mark_dirty(view, change.a.pt, change.b.pt, inserted)
+                checker.record_edit(view, change.a.pt, change.b.pt, inserted)
+                track_language_edit(view, removed, inserted)
+                shift_ignored_ranges(view, change.a.pt, change.b.pt, inserted)
 
-                # On text change we need to shift all problems situated after the change
-                for problem in problems:
-                    if problem['offset']>=change.a.pt: # Needs shifting
-                        shift_offset(problem, offset)
+                if hidden:
+                    hidden.shift(change.a.pt, change.b.pt, inserted)
 
+                if problems:
+                    log("TextChange", change, inserted - removed)
+
+                    # On text change we need to shift all problems situated after the change
+                    problems.shift(change.a.pt, change.b.pt, inserted)
+                    edited = merge_edit(edited, change.a.pt, change.b.pt, inserted)
+
+            if edited:
+                # Only problems around the edit can have been solved
+                recompute_highlights(view, [sublime.Region(a, b) for a, b in edited])
 
-class LanguageToolListener(sublime_plugin.EventListener):
-    def on_modified(self, view):
-        # buffer text was changed, recompute region highlights
-        recompute_highlights(view)
 
+class LanguageToolListener(sublime_plugin.EventListener):
+    def on_close(self, view):
+        checker.cancel_check(view)
+        forget_view(view.id())
+
+    def on_selection_modified(self, view):
+        # the viewport may have moved, check what is visible first
+        checker.prioritize_check(view)
+
+    def on_activated(self, view):
+        note_activated(view)
+        project.apply_results(view)
+        checker.restore_view(view)
+        checker.prioritize_check(view)
+        # views may hold more problems since results were stored
+        project.trim_results()
+
+    def on_load(self, view):
+        window = view.window()
+        if window and view == window.active_view():
+            project.apply_results(view)
+
+    @timed('listener.hover')
     def on_hover(self, view, point, hover_zone):
         if hover_zone == 1: # sublime.HoverZone.TEXT
             if not is_ignored(view, point):
-                for problem in get_problems(view):
-                    if get_region_for_problem(problem).contains(point):
-                        log("OnHover", "show_popup", problem)
+                problem = get_problems(view).at(point)
+                if problem:
+                    log("OnHover", "show_popup", problem)
 
-                        view.show_popup(
-                            generate_html_popup(view, problem),
-                            max_width=512,
-                            max_height=512,
-                            location=point,
-                            on_navigate=self.on_navigate)
+                    view.show_popup(
+                        generate_html_popup(view, problem),
+                        max_width=512,
+                        max_height=512,
+                        location=point,
+                        on_navigate=self.on_navigate)
 
     def on_navigate(self, link):
         log("Navigate", link)
@@ -288,29 +338,29 @@ class LanguageToolListener(sublime_plugin.EventListener):
                 return
 
             view.hide_popup()
-            problem = find_by_id(get_problems(view), str(problem_id))
-            if problem:
-                view.run_command("handle_replacement", {
-                    "problem": problem,
-                    "replacement_id": replacement_id,
-                })
-            else:
-                log("Navigate", "Error: could not find problem", problem_id, "in", view)
+            view.run_command("handle_replacement", {
+                "problem_id": str(problem_id),
+                "replacement_id": replacement_id,
+            })
         if link.startswith("showall:"):
             problem_id = link.replace('showall:', '')
-            problem = find_by_id(get_problems(view), problem_id)
+            problem = get_problems(view).get(problem_id)
             view.update_popup(generate_html_popup(view, problem, show_all_replacements=True))
 
 
 
 class HandleReplacementCommand(sublime_plugin.TextCommand):
-    def run(self, edit, problem, replacement_id):
-        if None in (replacement_id, problem):
+    def run(self, edit, problem_id, replacement_id):
+        if None in (replacement_id, problem_id):
             log("HandleReplacement", "Error: one of the required arguments is not set")
             return
-        if replacement_id >= len(problem['replacements']):
-            log("HandleReplacement", "Error: replacement_id not found in problem['replacements']")
+        problem = get_problems(self.view).get(problem_id)
+        if problem is None:
+            log("HandleReplacement", "Error: could not find problem", problem_id, "in", self.view)
+            return
+        if replacement_id >= len(problem.replacements):
+            log("HandleReplacement", "Error: replacement_id not found in problem.replacements")
             return
 
         log("HandleReplacement", "replacing", replacement_id, problem)
-        self.view.replace(edit, get_region_for_problem(problem), problem['replacements'][replacement_id])
+        self.view.replace(edit, get_region_for_problem(problem), problem.replacements[replacement_id])
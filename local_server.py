@@ -0,0 +1,245 @@
+"""
+Local LanguageTool servers managed by the plugin.
+
+A pool of `org.languagetool.server.HTTPServer` processes is spawned from the
+`languagetool_jar` setting, one per port starting at `local_server_port`. A
+monitor thread polls each instance's health endpoint, warms freshly started
+instances up with a check per language of `warmup_languages` (a cold JVM is
+very slow on its first requests) and restarts instances which crashed.
+While the pool runs, checks are spread across its ready instances. If an
+instance cannot be (re)started at all, e.g. because `java_path` is wrong, the
+pool is stopped and checks go to the configured server again.
+"""
+
+import os
+import subprocess
+import threading
+import time
+
+import sublime
+
+from .utils import get_settings, log
+from .ui import show_panel_text
+from . import server
+
+_POOL = None
+
+WARMUP_TEXT = 'This is a short text to warm up the LanguageTool server.'
+
+def get_pool():
+    """Return the running local server pool, or None."""
+    return _POOL
+
+def start_pool():
+    """Start the local server pool according to settings.
+
+    Returns:
+      ServerPool: the started pool.
+
+    Raises:
+      ValueError: if the LanguageTool JAR file cannot be found, or the
+        server processes cannot be started.
+    """
+    global _POOL
+    stop_pool()
+    settings = get_settings()
+    jar_path = settings.get('languagetool_jar')
+    if not jar_path:
+        raise ValueError('Setting languagetool_jar is undefined')
+    if not os.path.isfile(jar_path):
+        raise ValueError(
+            'Error, could not find LanguageTool\'s JAR file (%s)'
+            '\n\n'
+            'Please install LT in this directory'
+            ' or modify the `languagetool_jar` setting.' % jar_path)
+
+    command = [settings.get('java_path', 'java'), '-cp', jar_path,
+               'org.languagetool.server.HTTPServer']
+    first_port = settings.get('local_server_port', 8081)
+    ports = range(first_port, first_port + settings.get('local_server_instances', 1))
+    pool = ServerPool(command, ports, settings.get('warmup_languages', ['en-US']))
+    try:
+        pool.start()
+    except OSError as e:
+        raise ValueError(get_start_error(command, e))
+    _POOL = pool
+    return pool
+
+def get_start_error(command, error):
+    return ('Error, could not start the LanguageTool server (%s)'
+            '\n\n%s\n\n'
+            'Please check the `java_path` setting.' % (' '.join(command), error))
+
+def stop_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.stop()
+        _POOL = None
+
+def plugin_unloaded():
+    stop_pool()
+
+
+class LocalServer:
+    """A LanguageTool server process listening on a local port."""
+
+    def __init__(self, command, port):
+        self.command = command + ['--port', str(port)]
+        self.port = port
+        self.url = 'http://localhost:%d/v2/check' % port
+        self.process = None
+        self.ready = False
+
+    def start(self):
+        log("LocalServer", "starting", self.command)
+        self.ready = False
+        kwargs = {}
+        if sublime.platform() == "windows":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            kwargs['startupinfo'] = startupinfo
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            **kwargs)
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_healthy(self):
+        """Return True if the server answers on its languages endpoint."""
+        url = self.url.replace('/check', '/languages')
+        client = server.HTTPClient(timeout=2)
+        try:
+            client.request('GET', url)
+            return True
+        except IOError:
+            return False
+        finally:
+            client.close()
+
+    def warm_up(self, languages):
+        for language in languages:
+            log("LocalServer", "warming up", self.port, "for", language)
+            server.getResponse(self.url, WARMUP_TEXT, language, [])
+
+    def stop(self):
+        self.ready = False
+        if self.is_running():
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class ServerPool:
+    """Local LanguageTool servers supervised by a monitor thread."""
+
+    name = 'local'
+
+    def __init__(self, command, ports, warmup_languages,
+                 poll_interval=0.5, health_interval=10, startup_timeout=120):
+        self.instances = [LocalServer(command, port) for port in ports]
+        self.warmup_languages = warmup_languages
+        self.poll_interval = poll_interval
+        self.health_interval = health_interval
+        self.startup_timeout = startup_timeout
+        self._next = 0
+        self._ready = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the instances and their monitor.
+
+        Raises:
+          OSError: if an instance cannot be started; none is left running.
+        """
+        try:
+            for instance in self.instances:
+                instance.start()
+        except OSError:
+            self.stop()
+            raise
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+    def fail(self, error):
+        """Stop the pool after an instance could not be restarted."""
+        log("LocalServer", "cannot restart instance:", error)
+        self.stop()
+
+        def report():
+            if _POOL is self:
+                stop_pool()
+            show_panel_text(get_start_error(self.instances[0].command, error))
+        sublime.set_timeout(report)
+
+    def stop(self):
+        self._stopped.set()
+        for instance in self.instances:
+            instance.stop()
+        with self._ready:
+            self._ready.notify_all()
+
+    def ready_count(self):
+        return sum(instance.ready for instance in self.instances)
+
+    def next_url(self, timeout=None):
+        """Return the URL of the next ready instance, round robin.
+
+        Blocks until an instance is ready, for at most `timeout` seconds
+        (default: the startup timeout).
+
+        Returns:
+          str: URL of the check endpoint, or None if no instance got ready.
+        """
+        if timeout is None:
+            timeout = self.startup_timeout
+        with self._ready:
+            self._ready.wait_for(
+                lambda: self.ready_count() or self._stopped.is_set(), timeout)
+            ready = [instance for instance in self.instances if instance.ready]
+            if not ready:
+                return None
+            self._next += 1
+            return ready[self._next % len(ready)].url
+
+    def _monitor(self):
+        started = {instance.port: time.monotonic() for instance in self.instances}
+        last_health_check = time.monotonic()
+        while not self._stopped.wait(self.poll_interval):
+            check_health = time.monotonic() - last_health_check > self.health_interval
+            if check_health:
+                last_health_check = time.monotonic()
+            for instance in self.instances:
+                if not instance.is_running():
+                    if instance.ready or instance.process is not None:
+                        log("LocalServer", "instance", instance.port, "exited, restarting")
+                    try:
+                        instance.start()
+                    except OSError as e:
+                        self.fail(e)
+                        break
+                    started[instance.port] = time.monotonic()
+                elif not instance.ready:
+                    if instance.is_healthy():
+                        instance.warm_up(self.warmup_languages)
+                        with self._ready:
+                            instance.ready = not self._stopped.is_set()
+                            self._ready.notify_all()
+                        log("LocalServer", "instance", instance.port, "ready")
+                        sublime.set_timeout(lambda: sublime.status_message(
+                            'Local LanguageTool server ready (%d/%d)'
+                            % (self.ready_count(), len(self.instances))))
+                    elif time.monotonic() - started[instance.port] > self.startup_timeout:
+                        log("LocalServer", "instance", instance.port, "did not start, restarting")
+                        instance.stop()
+                elif check_health and not instance.is_healthy():
+                    log("LocalServer", "instance", instance.port, "stopped answering, restarting")
+                    instance.stop()
+                if self._stopped.is_set():
+                    break
@@ -0,0 +1,341 @@
+"""
+Project-wide checks.
+
+Checks all open views of a window, or every file matching
+`project_file_patterns` under the window's folders. Files are read and split
+in the background, and the chunks of all of them go through the request
+scheduler (see server.Scheduler), so that throughput is bounded by the
+parallel requests the server accepts rather than by one round trip per file.
+Paragraphs found in the cache are not sent again.
+
+Problems are listed in an output panel as soon as each file is done, grouped
+by file, with Sublime's result navigation. Highlights are only drawn when the
+view of a file is activated, and only if its text did not change since it
+was checked. Results waiting for their view count against
+`max_retained_problems` along with problems of views: the oldest are dropped
+when over budget, leaving only the panel entries of their files.
+"""
+
+import bisect
+import collections
+import fnmatch
+import hashlib
+import os
+import re
+
+import sublime
+
+from .utils import *
+from .ui import *
+from . import server
+from .cache import get_cache, make_key
+from .checker import (Chunk, cancel_check, enable_live_check, get_check_parameters,
+                      shed_problems)
+
+PANEL = 'languagetool_project'
+
+# after interactive checks, whose priority is a distance to the viewport
+_PRIORITY = 1 << 40
+
+_PROJECT_CHECKS = {}  # window id -> ProjectCheck
+# file name (or view id of unsaved views) -> (digest, problems), oldest first
+_RESULTS = view_state(collections.OrderedDict())
+
+def check_project(window, folders=False):
+    """Check open views of window, or files under its folders.
+
+    Args:
+      folders (bool): check files matching `project_file_patterns` under the
+        window's folders instead of open views. Open files are read from
+        their view, including unsaved changes.
+    """
+    view = window.active_view()
+    check = ProjectCheck(window, *get_check_parameters(view))
+    check.start()
+
+    views = [v for v in window.views() if v.size() and not v.is_loading()]
+    if not folders:
+        for v in views:
+            check.add_view(v)
+        check.listed()
+        return check
+
+    settings = get_settings()
+    patterns = settings.get('project_file_patterns', ['*.txt', '*.md'])
+    max_size = settings.get('project_max_file_size', 1000000)
+    opened = {v.file_name(): v for v in views if v.file_name()}
+    paths = find_files(window.folders(), patterns, max_size)
+
+    def read_files():
+        for path in paths:
+            if not check.is_current():
+                return
+            if path in opened:
+                view = opened[path]
+                sublime.set_timeout(lambda view=view: check.add_view(view))
+                continue
+            try:
+                with open(path, encoding='utf-8') as f:
+                    text = f.read()
+            except (IOError, UnicodeDecodeError) as e:
+                log("ProjectCheck", "skipping", path, e)
+                continue
+            check.add_text(path, path, text)
+        sublime.set_timeout(check.listed)
+
+    sublime.set_timeout_async(read_files)
+    return check
+
+def find_files(folders, patterns, max_size):
+    """Yield paths of files under folders matching any of patterns."""
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                if not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getsize(path) <= max_size:
+                        yield path
+                except OSError:
+                    pass
+
+def get_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def get_results_key(view):
+    return view.file_name() or view.id()
+
+def count_results():
+    """Return (files, problems) of results waiting for their view."""
+    return len(_RESULTS), sum(len(problems) for digest, problems in _RESULTS.values())
+
+def trim_results():
+    """Drop the oldest results beyond the budget left by problems of views."""
+    budget = get_settings().get('max_retained_problems', 100000) - count_retained_problems()
+    files, total = count_results()
+    while _RESULTS and total > budget:
+        key, (digest, problems) = _RESULTS.popitem(last=False)
+        total -= len(problems)
+        log("ProjectCheck", "dropping results of", key)
+        count('project.dropped_results')
+
+def apply_results(view):
+    """Highlight problems a project check found in view, if any.
+
+    Results are dropped if the text of view changed since it was checked.
+    """
+    if view.is_loading():
+        return
+    entry = _RESULTS.pop(get_results_key(view), None)
+    if entry is None:
+        return
+    digest, problems = entry
+    if get_digest(view.substr(sublime.Region(0, view.size()))) != digest:
+        log("ProjectCheck", "dropping outdated results of", view.file_name())
+        return
+
+    cancel_check(view)
+    erase_highlights(view)
+    index_ignored_ranges(view)
+    found = []
+    for problem in problems:
+        if not is_ignored(view, problem.offset):
+            problem.originalContent = view.substr(get_region_for_problem(problem))
+            problem.id = new_problem_id()
+            found.append(problem)
+    save_problems(view, found)
+    render_highlights(view)
+    enable_live_check(view)
+    shed_problems()
+
+
+class FileResult:
+    """Problems found in the text of a file, as its chunks complete."""
+
+    def __init__(self, key, name, text, view=None):
+        self.key = key
+        self.name = name
+        self.text = text
+        self.view = view
+        self.change_count = view.change_count() if view else None
+        self.problems = []
+        self.pending = 0
+
+    def filter(self):
+        """Drop problems in ignored scopes, if the file is open unchanged."""
+        view = self.view
+        if view and view.is_valid() and view.change_count() == self.change_count:
+            self.problems = [problem for problem in self.problems
+                             if not is_ignored(view, problem.offset)]
+
+    def add(self, offset, problems):
+        for problem in problems:
+            shift_offset(problem, offset)
+            self.problems.append(problem)
+
+    def format(self):
+        """Return the panel entry of the file, or None if it has no problem."""
+        if not self.problems:
+            return None
+        starts = [0] + [m.end() for m in re.finditer('\n', self.text)]
+        lines = ['%s:' % self.name]
+        for problem in self.problems:
+            row = bisect.bisect_right(starts, problem.offset) - 1
+            column = problem.offset - starts[row]
+            lines.append('  %d:%d  %s (%s)' % (row + 1, column + 1,
+                                               problem.message, problem.rule))
+        return '\n'.join(lines) + '\n\n'
+
+
+class ProjectCheck:
+    """A check of several files of a window, reported in an output panel."""
+
+    def __init__(self, window, server_url, language, ignored_ids, pool=None):
+        self.window = window
+        self.server_url = server_url
+        self.language = language
+        self.ignored_ids = ignored_ids
+        self.pool = pool
+        self.futures = []
+        self.files = 0
+        self.done = 0
+        self.found = 0
+        self.complete = False  # all files were listed
+
+    def is_current(self):
+        return _PROJECT_CHECKS.get(self.window.id()) is self
+
+    def start(self):
+        previous = _PROJECT_CHECKS.get(self.window.id())
+        if previous:
+            previous.cancel()
+        _PROJECT_CHECKS[self.window.id()] = self
+
+        panel = self.window.create_output_panel(PANEL)
+        panel.settings().set('result_file_regex', r'^(\S.*):$')
+        panel.settings().set('result_line_regex', r'^\s+(\d+):(\d+)')
+        panel.settings().set('word_wrap', False)
+        panel.set_read_only(True)
+        self.window.run_command('show_panel', {'panel': 'output.' + PANEL})
+        view = self.window.active_view()
+        if view:
+            show_progress(view, self.status)
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+    def status(self):
+        if self.is_current() and not (self.complete and self.done == self.files):
+            return 'LanguageTool: checked %d/%d files' % (self.done, self.files)
+
+    def add_view(self, view):
+        if self.is_current() and view.is_valid():
+            self.add_text(get_results_key(view), view.file_name() or view.name()
+                          or 'untitled', view.substr(sublime.Region(0, view.size())),
+                          view)
+
+    def add_text(self, key, name, text, view=None):
+        """Queue text of a file for checking (may run off the main thread)."""
+        self.files += 1
+        result = FileResult(key, name, text, view)
+        # the disk cache is only queried off the main thread
+        sublime.set_timeout_async(lambda: self.lookup(result))
+
+    def lookup(self, result):
+        """Add cached problems of a file and send the rest (off the main thread)."""
+        if not self.is_current():
+            return
+        text = result.text
+        max_size = get_settings().get('max_chunk_size', 20000)
+        pieces = split_paragraphs(text, max_size)
+        keys = [self.cache_key(piece) for offset, piece in pieces]
+        cache = get_cache()
+        cache.prefetch(keys)
+
+        dirty = []
+        dirty_keys = {}
+        for (offset, piece), key in zip(pieces, keys):
+            problems = cache.get(key)
+            if problems is None:
+                dirty.append((offset, piece))
+                dirty_keys[offset] = key
+            else:
+                result.add(offset, problems)
+
+        chunks = [Chunk(batch, [dirty_keys[offset] for offset, piece in batch])
+                  for batch in pack_pieces(dirty, max_size)]
+        result.pending = len(chunks)
+        if not chunks:
+            sublime.set_timeout(lambda: self.finish_file(result))
+            return
+
+        scheduler = server.get_scheduler()
+        for chunk in chunks:
+            future = scheduler.submit(self.pool or self.server_url, chunk.text,
+                                      self.language, self.ignored_ids, _PRIORITY)
+            future.add_done_callback(
+                lambda future, chunk=chunk: self.parse(result, chunk, future))
+            self.futures.append(future)
+
+    def cache_key(self, text):
+        return make_key(text, self.server_url, self.language, self.ignored_ids)
+
+    def parse(self, result, chunk, future):
+        if future.cancelled() or not self.is_current():
+            return
+        try:
+            found = chunk.parse(future)
+        except Exception as e:
+            # errors of done callbacks are swallowed: the check would never end
+            log("ProjectCheck", "Error:", e)
+            found = None
+        sublime.set_timeout(lambda: self.receive(result, chunk, found))
+
+    def receive(self, result, chunk, found):
+        if not self.is_current():
+            return
+        result.pending -= 1
+
+        if found is not None:
+            for (offset, text), segment_problems in zip(chunk.segments, found):
+                result.add(offset, segment_problems)
+
+        if result.pending == 0:
+            self.finish_file(result)
+
+    def finish_file(self, result):
+        """Report problems of a checked file (runs on the main thread)."""
+        if not self.is_current():
+            return
+        self.done += 1
+        result.problems.sort(key=lambda problem: problem.offset)
+        result.filter()
+        self.found += len(result.problems)
+        _RESULTS[result.key] = (get_digest(result.text), result.problems)
+        trim_results()
+
+        entry = result.format()
+        if entry:
+            self.append(entry)
+        view = self.window.active_view()
+        if view and get_results_key(view) == result.key:
+            apply_results(view)
+        self.report()
+
+    def listed(self):
+        """Note that all files to check were queued."""
+        self.complete = True
+        self.report()
+
+    def report(self):
+        if self.is_current() and self.complete and self.done == self.files:
+            self.append('%d problems in %d files\n' % (self.found, self.files))
+
+    def append(self, text):
+        panel = self.window.find_output_panel(PANEL)
+        if panel:
+            panel.run_command('append', {'characters': text, 'force': True,
+                                         'scroll_to_end': False})
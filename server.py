@@ -1,36 +1,633 @@
-import sublime
+import base64
+import bisect
+import gzip
+import itertools
 import json
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from .utils import log
+from .utils import count, get_settings, log, parse_match, text_size, timed
 
 try:
-    from urlparse import urlencode
-    from urllib2 import urlopen
+    from urlparse import unquote, urlencode, urlsplit
+    from urllib import getproxies, proxy_bypass
+    import httplib as http_client
 except ImportError:
-    from urllib.parse import urlencode
-    from urllib.request import urlopen
+    from urllib.parse import unquote, urlencode, urlsplit
+    from urllib.request import getproxies, proxy_bypass
+    import http.client as http_client
 
-def getResponse(server, text, language, disabledRules):
+# errors meaning the server closed an idle keep-alive connection
+_DROPPED = (getattr(http_client, 'RemoteDisconnected', http_client.BadStatusLine),
+            BrokenPipeError, ConnectionResetError)
+
+def getResponse(server, text, language, disabledRules, annotation=None):
+    result = check(server, text, language, disabledRules, annotation)
+    return result['matches'] if result else None
+
+def check(server, text, language, disabledRules, annotation=None):
+    """Check text and return the decoded server response, or None.
+
+    Args:
+      annotation (list): if given, `text` split into parts of plain text
+        ({'text': ...}) and markup ({'markup': ...}), sent as LanguageTool's
+        `data` parameter so that the server skips markup. Match offsets
+        still refer to `text`.
+
+    Returns:
+      dict: the response, whose `matches` are Problems (see decode_response).
+    """
     payload = {
         'language': language,
-        'text': text.encode('utf8'),
         'User-Agent': 'sublime',
         'disabledRules' : ','.join(disabledRules)
     }
-    content = _post(server, payload)
+    if annotation:
+        payload['data'] = json.dumps({'annotation': annotation}).encode('utf8')
+    else:
+        payload['text'] = text.encode('utf8')
+    with timed('server.request'):
+        content = _post(server, payload)
     if content:
-        j = json.loads(content.decode('utf-8'))
-        return j['matches']
+        with timed('server.decode'):
+            return decode_response(content)
     else:
         return None
 
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DECODER = json.JSONDecoder()
+
+def decode_response(content):
+    """Decode a check response, turning its matches into problems.
+
+    Matches are decoded one at a time, and each is turned into a Problem
+    (see parse_match) before the next is read, so that the match objects of
+    a large response, with their context and sentence, are never all held
+    at once as with json.loads().
+
+    Returns:
+      dict: the response, with a list of Problems as `matches`.
+
+    Raises:
+      ValueError: if content is not a JSON object, or has no matches.
+    """
+    text = content.decode('utf-8')
+    response = {}
+
+    def skip(position, expected=None):
+        position = _WHITESPACE.match(text, position).end()
+        if expected is not None:
+            if text[position:position + 1] != expected:
+                raise ValueError('Expected %r at %d' % (expected, position))
+            position = _WHITESPACE.match(text, position + 1).end()
+        return position
+
+    position = skip(0, '{')
+    while text[position:position + 1] != '}':
+        key, position = _DECODER.raw_decode(text, position)
+        position = skip(position, ':')
+        if key == 'matches':
+            matches = response[key] = []
+            position = skip(position, '[')
+            while text[position:position + 1] != ']':
+                match, position = _DECODER.raw_decode(text, position)
+                matches.append(parse_match(match))
+                position = skip(position)
+                if text[position:position + 1] == ',':
+                    position = skip(position + 1)
+            position += 1
+        else:
+            response[key], position = _DECODER.raw_decode(text, position)
+        position = skip(position)
+        if text[position:position + 1] == ',':
+            position = skip(position + 1)
+        elif text[position:position + 1] != '}':
+            raise ValueError('Expected , or } at %d' % position)
+    if 'matches' not in response:
+        raise ValueError('No matches in response')
+    return response
+
+def plugin_unloaded():
+    if _SCHEDULER is not None:
+        _SCHEDULER.shutdown()
+    if _CLIENT is not None:
+        _CLIENT.close()
+
+
+class HTTPClient:
+    """Thread-safe pool of persistent (keep-alive) HTTP connections.
+
+    Connections are kept per (scheme, host, port) and reused across requests,
+    saving a TCP and TLS handshake each time. Responses are requested
+    gzip-compressed. A request on a reused connection that the server closed
+    while it was idle is retried once on a new connection; other failures,
+    timeouts included, are not retried.
+
+    Proxies are taken from the environment (`http_proxy`, `https_proxy` and
+    `no_proxy`), like urllib does: HTTPS goes through a CONNECT tunnel.
+    """
+
+    def __init__(self, timeout=30, max_idle=8):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = {}  # (scheme, host, port) -> idle connections
+        self._proxies = {}  # (scheme, host, port) -> proxy or None
+        self._lock = threading.Lock()
+
+    def _get_proxy(self, key):
+        """Return (host, port, headers) of the proxy to reach key, or None."""
+        if key not in self._proxies:
+            scheme, host, port = key
+            proxy = getproxies().get(scheme)
+            if not proxy or proxy_bypass(host):
+                self._proxies[key] = None
+            else:
+                if '://' not in proxy:
+                    proxy = 'http://' + proxy
+                parts = urlsplit(proxy)
+                headers = {}
+                if parts.username:
+                    credentials = '%s:%s' % (unquote(parts.username),
+                                             unquote(parts.password or ''))
+                    headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                        credentials.encode('utf8')).decode('ascii')
+                self._proxies[key] = (parts.hostname, parts.port or 80, headers)
+        return self._proxies[key]
+
+    def _connect(self, key):
+        scheme, host, port = key
+        proxy = self._get_proxy(key)
+        if proxy is None:
+            if scheme == 'https':
+                return http_client.HTTPSConnection(host, port, timeout=self.timeout)
+            return http_client.HTTPConnection(host, port, timeout=self.timeout)
+        proxy_host, proxy_port, proxy_headers = proxy
+        if scheme == 'https':
+            connection = http_client.HTTPSConnection(proxy_host, proxy_port,
+                                                     timeout=self.timeout)
+            connection.set_tunnel(host, port, proxy_headers)
+            return connection
+        return http_client.HTTPConnection(proxy_host, proxy_port, timeout=self.timeout)
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def post(self, url, data):
+        """POST form data to url and return the (decompressed) response body.
+
+        Raises:
+          IOError: if the request fails or the server returns an error.
+        """
+        return self.request('POST', url, data)
+
+    def request(self, method, url, data=None):
+        """Send a request and return the (decompressed) response body.
+
+        Raises:
+          IOError: if the request fails or the server returns an error.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8',
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+            'User-Agent': 'sublime',
+        }
+        proxy = self._get_proxy(key)
+        if proxy and parts.scheme == 'http':
+            # plain HTTP proxies take the absolute URL
+            path = url
+            headers.update(proxy[2])
+
+        connection, reused = self._checkout(key)
+        while True:
+            try:
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http_client.HTTPException, OSError) as e:
+                connection.close()
+                if reused and isinstance(e, _DROPPED):
+                    log("HTTPClient", "reconnecting to", parts.hostname, "after", repr(e))
+                    count('http.reconnects')
+                    connection, reused = self._connect(key), False
+                    continue
+                raise IOError(e)
+            break
+        count('http.requests')
+        count('http.bytes_sent', len(data or b''))
+        count('http.bytes_received', len(body))
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+
+        if response.status >= 400:
+            raise IOError('HTTP %d %s' % (response.status, response.reason))
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+            count('http.bytes_decompressed', len(body))
+        return body
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+class TokenBucket:
+    """Token bucket holding at most `capacity` tokens, refilled over `period` seconds."""
+
+    def __init__(self, capacity, period=60):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        """Return seconds to wait before `amount` tokens are available."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+
+class RateLimit:
+    """Usage limits of a server, e.g. those of the public LanguageTool API."""
+
+    def __init__(self, requests_per_minute=None, bytes_per_minute=None,
+                 bytes_per_request=None):
+        self.requests = requests_per_minute and TokenBucket(requests_per_minute)
+        self.bytes = bytes_per_minute and TokenBucket(bytes_per_minute)
+        self.bytes_per_request = bytes_per_request
+
+    def delay(self, size):
+        """Return seconds to wait before sending a request of `size` bytes."""
+        delays = [0]
+        if self.requests:
+            delays.append(self.requests.delay(1))
+        if self.bytes:
+            delays.append(self.bytes.delay(size))
+        return max(delays)
+
+    def take(self, size):
+        if self.requests:
+            self.requests.take(1)
+        if self.bytes:
+            self.bytes.take(size)
+
+    def expected_wait(self, count, size):
+        """Estimate seconds needed to send `count` requests of `size` bytes in total."""
+        waits = [0]
+        if self.requests:
+            waits.append((count - self.requests.tokens) / self.requests.rate)
+        if self.bytes:
+            waits.append((size - self.bytes.tokens) / self.bytes.rate)
+        return max(waits)
+
+
+class Request:
+    """A check request waiting in the scheduler queue.
+
+    `future` resolves when the request was sent; each submitter of the
+    request waits on its own future in `waiters`.
+    """
+
+    def __init__(self, server, text, language, disabled_rules, priority,
+                 sequence, annotation=None):
+        self.key = None  # see Scheduler.submit
+        self.server = server
+        self.text = text
+        self.annotation = annotation
+        self.language = language
+        self.disabled_rules = disabled_rules
+        self.priority = priority
+        self.sequence = sequence
+        self.size = text_size(text)
+        self.future = Future()
+        self.waiters = []
+
+    def cancelled(self):
+        """Whether every submitter of the request cancelled it."""
+        return all(waiter.cancelled() for waiter in self.waiters)
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def can_merge(self, other):
+        # The server detects one language per request, which must not be
+        # shared by texts of unrelated documents
+        return self.language != 'auto' and \
+            (self.server, self.language, self.disabled_rules) == \
+            (other.server, other.language, other.disabled_rules)
+
+
+class Scheduler:
+    """Send check requests in priority order, honouring server rate limits.
+
+    Requests are queued with a priority (lower is more urgent) and sent by a
+    dispatcher thread through a bounded thread pool, as soon as a worker is
+    free and the token buckets of their server allow it. Small pending requests with the same
+    parameters are merged into a single request, up to the server's request
+    size limit; their matches are split back when the response arrives.
+    Requests in `auto` language mode are never merged.
+
+    Identical requests (same server, parameters and text) submitted while one
+    is pending or in flight are coalesced: it is only sent once, and its
+    response is handed to every submitter.
+
+    `server` is either a URL or an object whose `next_url()` method returns
+    the URL to use (see local_server.ServerPool).
+    """
+
+    SEPARATOR = '\n\n'
+
+    def __init__(self, workers, limits):
+        self.limits = {url: RateLimit(**limit) for url, limit in limits.items()}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._workers = threading.Semaphore(workers)
+        self._pending = []
+        self._in_flight = {}  # request key -> Request
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def submit(self, server, text, language, disabled_rules, priority=0,
+               annotation=None):
+        """Queue a check request (see `check` for annotation).
+
+        Returns:
+          Future: resolves to the decoded server response, or None.
+          Cancelling it drops the request unless another submitter of an
+          identical request waits for it.
+        """
+        disabled_rules = tuple(disabled_rules)
+        key = (getattr(server, 'name', server), language, disabled_rules,
+               json.dumps(annotation) if annotation else None, text)
+        waiter = Future()
+        with self._condition:
+            request = self._in_flight.get(key)
+            if request is None:
+                request = Request(server, text, language, disabled_rules,
+                                  priority, next(self._sequence), annotation)
+                request.key = key
+                self._in_flight[key] = request
+                request.future.add_done_callback(
+                    lambda future: self._resolve(request))
+                self._pending.append(request)
+                self._condition.notify()
+            else:
+                count('scheduler.coalesced')
+                request.priority = min(request.priority, priority)
+            request.waiters.append(waiter)
+        return waiter
+
+    def _resolve(self, request):
+        """Hand the outcome of request to all its submitters."""
+        with self._condition:
+            if self._in_flight.get(request.key) is request:
+                del self._in_flight[request.key]
+            waiters = list(request.waiters)
+        future = request.future
+        for waiter in waiters:
+            if future.cancelled():
+                waiter.cancel()
+            elif waiter.set_running_or_notify_cancel():
+                if future.exception():
+                    waiter.set_exception(future.exception())
+                else:
+                    waiter.set_result(future.result())
+
+    def reprioritize(self, get_priority):
+        """Update priorities of pending requests.
+
+        Args:
+          get_priority (callable): called with each pending request, returns
+            its new priority, or None to leave it unchanged. Submitters are
+            identified by the futures in `request.waiters`.
+        """
+        with self._condition:
+            for request in self._pending:
+                priority = get_priority(request)
+                if priority is not None:
+                    request.priority = priority
+            self._condition.notify()
+
+    def retag(self, waiters, language):
+        """Change the language of pending requests submitted through waiters.
+
+        Requests which other submitters wait for as well are left unchanged.
+        """
+        waiters = set(waiters)
+        with self._condition:
+            for request in self._pending:
+                if request.language == language or not waiters.issuperset(request.waiters):
+                    continue
+                if self._in_flight.get(request.key) is request:
+                    del self._in_flight[request.key]
+                request.language = language
+                request.key = request.key[:1] + (language,) + request.key[2:]
+                self._in_flight.setdefault(request.key, request)
+            self._condition.notify()
+
+    def queue_depth(self):
+        return len(self._pending)
+
+    def expected_wait(self):
+        """Estimate seconds before all pending requests are sent."""
+        with self._condition:
+            waits = [0]
+            for server, limit in self.limits.items():
+                requests = [r for r in self._pending
+                            if getattr(r.server, 'name', r.server) == server]
+                if requests:
+                    waits.append(limit.expected_wait(
+                        len(requests), sum(r.size for r in requests)))
+            return max(waits)
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            for request in self._pending:
+                request.future.cancel()
+            self._pending = []
+            self._condition.notify()
+        self._executor.shutdown(wait=False)
+
+    def _limit(self, server):
+        return self.limits.get(getattr(server, 'name', server))
+
+    def _next_batch(self):
+        """Pop the most urgent requests which may be sent now.
+
+        Returns:
+          tuple: (requests, wait) where requests is a list of mergeable
+          requests, or None, and wait the seconds until one may be sent.
+        """
+        for request in self._pending:
+            if request.cancelled():
+                request.future.cancel()
+        self._pending = [r for r in self._pending if not r.future.cancelled()]
+        wait = None
+        blocked = []
+        for request in sorted(self._pending):
+            if any(request.server == other.server for other in blocked):
+                continue
+            limit = self._limit(request.server)
+            delay = limit.delay(request.size) if limit else 0
+            if delay > 0:
+                blocked.append(request)
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            batch = [request]
+            size = request.size
+            max_size = limit and limit.bytes_per_request
+            max_size = max_size or get_settings().get('max_chunk_size', 20000)
+            for other in sorted(self._pending):
+                if other is request or not request.can_merge(other):
+                    continue
+                merged_size = size + len(self.SEPARATOR) + other.size
+                if merged_size > max_size or (limit and limit.delay(merged_size) > 0):
+                    continue
+                batch.append(other)
+                size = merged_size
+            for member in batch:
+                self._pending.remove(member)
+            if limit:
+                limit.take(size)
+            return batch, 0
+        return None, wait
+
+    def _dispatch(self):
+        while True:
+            # Requests stay queued (and can be re-prioritized) until a worker is free
+            self._workers.acquire()
+            with self._condition:
+                batch, wait = self._next_batch()
+                while batch is None and not self._stopped:
+                    self._condition.wait(wait)
+                    batch, wait = self._next_batch()
+                if self._stopped:
+                    return
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if batch:
+                self._executor.submit(self._send, batch)
+            else:
+                self._workers.release()
+
+    def _send(self, batch):
+        try:
+            self._send_batch(batch)
+        finally:
+            self._workers.release()
+
+    def _send_batch(self, batch):
+        first = batch[0]
+        try:
+            url = first.server
+            if hasattr(url, 'next_url'):
+                url = url.next_url()
+            if url is None:
+                log("Scheduler", "no server to send request to")
+                result = None
+            else:
+                text = self.SEPARATOR.join(request.text for request in batch)
+                annotation = None
+                if any(request.annotation for request in batch):
+                    annotation = []
+                    for index, request in enumerate(batch):
+                        if index:
+                            annotation.append({'text': self.SEPARATOR})
+                        annotation.extend(request.annotation or [{'text': request.text}])
+                log("Scheduler", "sending", len(batch), "merged requests,",
+                    len(self._pending), "pending")
+                result = check(url, text, first.language, first.disabled_rules,
+                               annotation)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        if result is None or len(batch) == 1:
+            first.future.set_result(result)
+            for request in batch[1:]:
+                request.future.set_result(None)
+            return
+
+        starts = []
+        position = 0
+        for request in batch:
+            starts.append(position)
+            position += len(request.text) + len(self.SEPARATOR)
+        matches = [[] for request in batch]
+        for problem in result['matches']:
+            index = bisect.bisect_right(starts, problem.offset) - 1
+            problem.offset -= starts[index]
+            if problem.offset + problem.length <= len(batch[index].text):
+                matches[index].append(problem)
+        for request, request_matches in zip(batch, matches):
+            request.future.set_result(dict(result, matches=request_matches))
+
+
+_SCHEDULER = None
+
+def get_scheduler():
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        settings = get_settings()
+        _SCHEDULER = Scheduler(settings.get('max_parallel_requests', 2),
+                               settings.get('rate_limits', {}))
+    return _SCHEDULER
+
+
+_CLIENT = None
+
+def get_client():
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = HTTPClient(timeout=get_settings().get('timeout', 30))
+    return _CLIENT
+
 # internal functions:
 
 def _post(server, payload):
     data = urlencode(payload).encode('utf8')
     try:
         log("Sending request to", server)
-        content = urlopen(server, data).read()
+        content = get_client().post(server, data)
         return content
-    except IOError:
+    except IOError as e:
+        log("Request failed:", e)
         return None
@@ -0,0 +1,14 @@
+"""
+Fake LanguageTool server executable: serves the mock server of the
+benchmarks on the port given after `--port`, ignoring other arguments.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'benchmarks'))
+
+from mock_server import MockServer  # noqa: E402
+
+MockServer(port=int(sys.argv[sys.argv.index('--port') + 1])).serve_forever()
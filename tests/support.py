@@ -0,0 +1,22 @@
+"""
+Shared setup of the tests.
+
+Loads the plugin as package `LanguageTool` against the fake `sublime` module
+of the benchmarks (see benchmarks/fake), so that tests run headless:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = os.path.join(os.path.dirname(HERE), 'benchmarks')
+sys.path.insert(0, BENCHMARKS)
+
+from run import load_plugin  # noqa: E402 (sets up the fake sublime module)
+import sublime  # noqa: E402
+
+plugin = load_plugin()
+if not sublime.windows():
+    sublime.Window()
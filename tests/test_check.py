@@ -0,0 +1,222 @@
+"""Tests of whole checks of views, against the mock server of the benchmarks."""
+
+import os
+import tempfile
+import threading
+import unittest
+
+
+from support import plugin, sublime
+from mock_server import MockServer
+
+TEXT = 'Some words here.\n\nMore words `code` there.\n'
+
+
+def add_problems(view, *specs):
+    """Give view problems at (offset, length, rule, replacements) specs."""
+    problems = []
+    for offset, length, rule, replacements in specs:
+        problem = plugin.utils.Problem(offset, length, rule, 'Typos', 'typo', replacements)
+        problem.originalContent = view.substr(sublime.Region(offset, offset + length))
+        problem.id = plugin.utils.new_problem_id()
+        problems.append(problem)
+    plugin.ui.render_highlights(view, plugin.utils.add_problems(view, problems))
+    return problems
+
+
+def get_texts(view):
+    return [view.substr(plugin.utils.get_region_for_problem(p))
+            for p in plugin.utils.get_problems(view)]
+
+
+class CheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer(density=0.5).start()
+        self.settings = sublime.load_settings('LanguageTool.sublime-settings')
+        self.settings.set('server', self.server.url)
+        plugin.cache.get_cache().clear()
+
+    def tearDown(self):
+        self.settings.set('annotate_markup', True)
+        self.settings.erase('max_chunk_size')
+        self.server.shutdown()
+
+    def new_view(self, text=TEXT, scopes=None):
+        return sublime.active_window().new_file(text, scopes)
+
+    def check(self, view):
+        view.run_command('language_tool')
+        sublime.run_main(timeout=10, until=lambda: not plugin.checker.is_checking(view))
+        return plugin.utils.get_problems(view)
+
+    def test_markup_is_part_of_cache_key(self):
+        start = TEXT.index('`')
+        scopes = [(start, start + 6, 'markup.raw.inline')]
+        self.settings.set('ignored-scopes', ['markup.raw.*'])
+        view = self.new_view(scopes=scopes)
+        self.check(view)
+        self.assertEqual(self.server.requests, 1)
+
+        # Sent as plain text, the code is checked too
+        self.settings.set('annotate_markup', False)
+        self.check(self.new_view(scopes=scopes))
+        self.assertEqual(self.server.requests, 2)
+
+        self.settings.set('annotate_markup', True)
+        self.check(self.new_view(scopes=scopes))
+        self.assertEqual(self.server.requests, 2)
+
+    def test_unchanged_text_is_served_from_cache(self):
+        first = self.check(self.new_view())
+        second = self.check(self.new_view())
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual([(p.offset, p.rule) for p in first],
+                         [(p.offset, p.rule) for p in second])
+
+    def test_disk_cache_is_read_off_the_main_thread(self):
+        directory = tempfile.TemporaryDirectory()
+        disk = plugin.cache.DiskCache(os.path.join(directory.name, 'matches.sqlite'),
+                                      1000000, 86400)
+        threads = []
+        get_many = disk.get_many
+
+        def record(keys):
+            threads.append(threading.current_thread())
+            return get_many(keys)
+
+        disk.get_many = record
+        memory = plugin.cache._CACHE
+        plugin.cache._CACHE = plugin.cache.MatchCache(100, 1000000, disk)
+        try:
+            first = self.check(self.new_view())
+            plugin.cache._CACHE.clear()
+            second = self.check(self.new_view())
+        finally:
+            plugin.cache._CACHE = memory
+            disk.close()
+            directory.cleanup()
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(len(first), len(second))
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_pinned_language_keeps_cached_results(self):
+        text = ''.join('Paragraph number %d.\n\n' % i for i in range(50))
+        self.check(self.new_view(text))
+        self.assertEqual(self.server.languages, ['auto'])
+        view = self.new_view(text)
+        plugin.utils.detect_language(view, {'code': 'en-US', 'name': 'English (US)',
+                                            'confidence': 1})
+        self.check(view)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_queued_chunks_use_pinned_language(self):
+        self.settings.set('max_chunk_size', 50)
+        self.server.latency = 0.1
+        text = ''.join('Paragraph number %d.\n\n' % i for i in range(40))
+        view = self.new_view(text)
+        self.check(view)
+        self.assertEqual(plugin.utils.get_detected_language(view)[0], 'en-US')
+        languages = self.server.languages
+        self.assertEqual(languages[0], 'auto')
+        self.assertEqual(languages[-1], 'en-US')
+        # only requests sent before the language was pinned detect it
+        self.assertLess(languages.count('auto'), languages.count('en-US'))
+
+    def test_results_are_moved_through_edits_made_in_flight(self):
+        self.server.density = 1
+        self.server.latency = 0.3
+        view = self.new_view('alpha beta gamma delta\n')
+        view.run_command('language_tool')
+        view.type_text(0, 'xx ')
+        view.type_text(view.substr(sublime.Region(0, view.size())).index('gamma') + 2, 'Z')
+        sublime.run_main(timeout=10, until=lambda: not plugin.checker.is_checking(view))
+        problems = plugin.utils.get_problems(view)
+        # gamma overlaps an edit and is dropped, the others follow the text
+        self.assertEqual([view.substr(plugin.utils.get_region_for_problem(p)) for p in problems],
+                         ['alpha', 'beta', 'delta'])
+        self.assertEqual([p.offset for p in problems], [3, 9, 21])
+        self.assertEqual([p.originalContent for p in problems], ['alpha', 'beta', 'delta'])
+
+    def test_fixes_are_applied_in_one_edit(self):
+        view = self.new_view('alpha beta gamma delta epsilon\n')
+        add_problems(view, (0, 10, 'A', ['ab']), (6, 4, 'A', ['BETA']),
+                     (11, 5, 'B', ['GAMMA']), (17, 5, 'A', ['DELTA', 'Delta']),
+                     (23, 7, 'A', ['EPSILON']))
+        batches = []
+        notify = view._notify
+
+        def record(changes):
+            batches.append(changes)
+            notify(changes)
+
+        view._notify = record
+        view.run_command('apply_language_tool_fixes', {'rule': 'A'})
+        # alpha beta overlaps the fix of beta, delta has two suggestions
+        self.assertEqual(view.substr(sublime.Region(0, view.size())),
+                         'alpha BETA gamma delta EPSILON\n')
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(get_texts(view), ['gamma', 'delta'])
+
+    def test_deactivated_rule_problems_follow_edits(self):
+        user_settings = sublime.load_settings('LanguageToolUser.sublime-settings')
+        self.addCleanup(user_settings.erase, 'ignored')
+        view = self.new_view('alpha beta gamma delta\n')
+        add_problems(view, (6, 4, 'A', ['BETA']), (11, 5, 'B', ['GAMMA']),
+                     (17, 5, 'A', ['DELTA']))
+        view.sel().clear()
+        view.sel().add(sublime.Region(7, 7))
+        view.run_command('deactivate_rule')
+        self.assertEqual(get_texts(view), ['gamma'])
+
+        view.type_text(0, 'xx ')
+        view.type_text(view.substr(sublime.Region(0, view.size())).index('delta') + 2, 'Z')
+        plugin.commands.ActivateRuleCommand(view).activate_callback(0)
+        # delta was solved meanwhile
+        self.assertEqual(get_texts(view), ['beta', 'gamma'])
+        self.assertEqual([p.offset for p in plugin.utils.get_problems(view)], [9, 14])
+        self.assertEqual(user_settings.get('ignored'), [])
+
+    def test_hidden_problems_count_against_the_budget(self):
+        self.addCleanup(self.settings.erase, 'max_retained_problems')
+        self.addCleanup(sublime.load_settings('LanguageToolUser.sublime-settings').erase,
+                        'ignored')
+        plugin.utils.forget_all_views()
+        background = self.new_view('alpha beta gamma delta\n')
+        add_problems(background, *[(offset, 4, 'A', ['X']) for offset in (0, 6, 11, 17)])
+        plugin.ui.deactivate_rule_problems('A')
+        self.assertEqual(plugin.utils.count_retained_problems(), 4)
+        self.assertIn('4 problems retained', plugin.checker.format_problem_counts())
+
+        self.settings.set('max_retained_problems', 5)
+        add_problems(self.new_view('alpha beta gamma delta\n'),
+                     *[(offset, 4, 'B', ['X']) for offset in (0, 6, 11, 17)])
+        plugin.checker.shed_problems()
+        self.assertEqual(len(plugin.utils.get_hidden_problems(background)), 0)
+        self.assertEqual(plugin.utils.count_retained_problems(), 4)
+
+    def test_response_without_matches_ends_the_check(self):
+        self.server.body = b'{"software": {}}'
+        view = self.new_view()
+        self.check(view)
+        self.assertFalse(plugin.checker.is_checking(view))
+        self.assertEqual(sublime._status[-1], 'Could not parse server response')
+
+    def test_parse_error_ends_the_check(self):
+        def fail(chunk, future):
+            raise RuntimeError('parse failed')
+
+        parse = plugin.checker.Chunk.parse
+        plugin.checker.Chunk.parse = fail
+        try:
+            view = self.new_view()
+            self.check(view)
+        finally:
+            plugin.checker.Chunk.parse = parse
+        self.assertFalse(plugin.checker.is_checking(view))
+        self.assertEqual(sublime._status[-1], 'Could not parse server response')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Tests of server.HTTPClient retries."""
+
+import socket
+import threading
+import unittest
+
+from support import plugin
+from mock_server import MockServer
+
+HTTPClient = plugin.server.HTTPClient
+
+RESPONSE = (b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n'
+            b'Connection: keep-alive\r\n\r\n{}')
+
+
+class ClosingServer:
+    """Answers one request per connection, then closes it as if idle."""
+
+    def __init__(self):
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.requests = 0
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/v2/check' % self.socket.getsockname()[1]
+
+    def serve(self):
+        while True:
+            connection, address = self.socket.accept()
+            data = b''
+            while b'\r\n\r\n' not in data:
+                data += connection.recv(4096)
+            headers, body = data.split(b'\r\n\r\n', 1)
+            length = int(headers.lower().split(b'content-length: ')[1].split(b'\r\n')[0])
+            while len(body) < length:
+                body += connection.recv(4096)
+            self.requests += 1
+            connection.sendall(RESPONSE)
+            connection.close()
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def test_reconnects_when_idle_connection_was_closed(self):
+        server = ClosingServer()
+        client = HTTPClient(timeout=5)
+        self.assertEqual(client.post(server.url, b'text=a'), b'{}')
+        self.assertEqual(client.post(server.url, b'text=b'), b'{}')
+        self.assertEqual(server.requests, 2)
+        client.close()
+
+    def test_does_not_retry_timeouts(self):
+        server = MockServer().start()
+        client = HTTPClient(timeout=0.5)
+        client.post(server.url, b'text=a')
+        server.latency = 1
+        with self.assertRaises(IOError):
+            client.post(server.url, b'text=b')
+        self.assertEqual(server.requests, 2)
+        client.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Tests of the local server pool, with a fake server executable."""
+
+import os
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+from support import plugin, sublime, HERE
+from LanguageTool import local_server
+
+FAKE_SERVER = [sys.executable, os.path.join(HERE, 'fake_languagetool.py')]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        sublime.run_main(timeout=0.05)
+    return condition()
+
+
+class ServerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = local_server.ServerPool(FAKE_SERVER, [free_port()], ['en-US'],
+                                            poll_interval=0.05)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_serves_checks_once_ready(self):
+        self.pool.start()
+        url = self.pool.next_url(timeout=10)
+        self.assertEqual(url, self.pool.instances[0].url)
+        self.assertEqual(plugin.server.getResponse(url, 'Hello world', 'en-US', [])[0].offset, 0)
+        plugin.server.get_client().close()
+
+    def test_restarts_crashed_instance(self):
+        self.pool.start()
+        self.assertIsNotNone(self.pool.next_url(timeout=10))
+        instance = self.pool.instances[0]
+        process = instance.process
+        process.kill()
+        self.assertTrue(wait(lambda: instance.process is not process and instance.ready))
+
+    def test_stops_when_restart_fails(self):
+        self.pool.start()
+        self.assertIsNotNone(self.pool.next_url(timeout=10))
+        instance = self.pool.instances[0]
+        instance.command[0] = '/nonexistent/java'
+        instance.process.kill()
+        self.assertTrue(wait(lambda: self.pool._stopped.is_set()))
+        self.assertIsNone(self.pool.next_url(timeout=1))
+
+
+class StartPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = sublime.load_settings('LanguageTool.sublime-settings')
+        self.jar = tempfile.NamedTemporaryFile(suffix='.jar')
+        self.settings.set('languagetool_jar', self.jar.name)
+        self.settings.set('local_server_port', free_port())
+
+    def tearDown(self):
+        local_server.stop_pool()
+        self.settings.erase('java_path')
+        self.jar.close()
+
+    def test_missing_java_is_reported(self):
+        self.settings.set('java_path', '/nonexistent/java')
+        with self.assertRaises(ValueError) as raised:
+            local_server.start_pool()
+        self.assertIn('java_path', str(raised.exception))
+        self.assertIsNone(local_server.get_pool())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""Tests of utils.ProblemIndex against a naive list of offsets."""
+
+import random
+import unittest
+
+from support import plugin
+
+Problem = plugin.utils.Problem
+ProblemIndex = plugin.utils.ProblemIndex
+
+
+class NaiveIndex:
+    """Offsets and lengths of problems, updated one by one."""
+
+    def __init__(self, problems):
+        self.problems = [[p.offset, p.length, p] for p in problems]
+        self.problems.sort(key=lambda entry: entry[0])
+
+    def shift(self, a, b, inserted):
+        for entry in self.problems:
+            if a <= entry[0] < b:
+                entry[0] = a
+            elif entry[0] >= b:
+                entry[0] += inserted - (b - a)
+
+    def at(self, point):
+        for offset, length, problem in reversed(self.problems):
+            if offset <= point <= offset + length:
+                return problem
+        return None
+
+    def after(self, point):
+        return [p for offset, length, p in self.problems if offset > point]
+
+    def before(self, point):
+        return [p for offset, length, p in reversed(self.problems) if offset < point]
+
+    def offsets(self):
+        return [(offset, problem) for offset, length, problem in self.problems]
+
+    def add(self, problems):
+        for problem in sorted(problems, key=lambda p: p.offset):
+            position = len([entry for entry in self.problems if entry[0] <= problem.offset])
+            self.problems.insert(position, [problem.offset, problem.length, problem])
+
+    def remove(self, problems):
+        removed = set(map(id, problems))
+        self.problems = [entry for entry in self.problems if id(entry[2]) not in removed]
+
+
+def make_problems(rng, count, size):
+    return [Problem(rng.randrange(size), rng.randrange(1, 8), 'RULE', 'Typos', 'typo')
+            for _ in range(count)]
+
+
+class SmallBlockIndex(ProblemIndex):
+    BLOCK_SIZE = 2
+
+
+class ProblemIndexTest(unittest.TestCase):
+
+    index_class = ProblemIndex
+
+    def check_offsets(self, index, naive):
+        self.assertEqual([(p.offset, p) for p in index], naive.offsets())
+
+    def test_shift_insertion(self):
+        problems = [Problem(offset, 3, 'RULE', 'Typos', 'typo') for offset in (0, 5, 10)]
+        index = self.index_class(problems)
+        index.shift(5, 5, 2)
+        self.assertEqual([p.offset for p in index], [0, 7, 12])
+
+    def test_shift_deletion_moves_problems_inside(self):
+        problems = [Problem(offset, 3, 'RULE', 'Typos', 'typo') for offset in (0, 5, 10)]
+        index = self.index_class(problems)
+        index.shift(3, 8, 0)
+        self.assertEqual([p.offset for p in index], [0, 3, 5])
+
+    def test_random_edits(self):
+        rng = random.Random(5)
+        for _ in range(50):
+            size = 500
+            problems = make_problems(rng, rng.randrange(1, 60), size)
+            index = self.index_class(problems)
+            naive = NaiveIndex(problems)
+            for _ in range(40):
+                a = rng.randrange(size)
+                b = min(size, a + rng.choice((0, 0, 1, rng.randrange(50))))
+                inserted = rng.choice((0, 1, rng.randrange(30)))
+                index.shift(a, b, inserted)
+                naive.shift(a, b, inserted)
+                size += inserted - (b - a)
+
+                point = rng.randrange(size + 1)
+                self.assertIs(index.at(point), naive.at(point))
+                self.assertEqual(list(index.after(point)), naive.after(point))
+                self.assertEqual(list(index.before(point)), naive.before(point))
+                if rng.random() < 0.2:
+                    index.flush()
+                if rng.random() < 0.1:
+                    self.check_offsets(index, naive)
+            self.check_offsets(index, naive)
+
+    def test_random_additions_and_removals(self):
+        rng = random.Random(11)
+        size = 2000
+        problems = make_problems(rng, 200, size)
+        index = self.index_class(problems)
+        naive = NaiveIndex(problems)
+        for _ in range(300):
+            a = rng.randrange(size)
+            b = min(size, a + rng.choice((0, 1, rng.randrange(30))))
+            inserted = rng.choice((0, 1, rng.randrange(30)))
+            index.shift(a, b, inserted)
+            naive.shift(a, b, inserted)
+            size += inserted - (b - a)
+            if rng.random() < 0.5:
+                added = make_problems(rng, rng.randrange(1, 10), size)
+                index.add(added)
+                naive.add(added)
+            else:
+                current = list(naive.after(-1))
+                removed = rng.sample(current, min(len(current), rng.randrange(1, 10)))
+                index.remove(removed)
+                naive.remove(removed)
+            point = rng.randrange(size + 1)
+            self.assertEqual(len(index), len(naive.problems))
+            self.assertIs(index.at(point), naive.at(point))
+            self.assertEqual(list(index.after(point)), naive.after(point))
+            self.assertEqual(list(index.before(point)), naive.before(point))
+        self.check_offsets(index, naive)
+
+    def test_changed_blocks(self):
+        problems = [Problem(offset, 3, 'RULE', 'Typos', 'typo') for offset in range(0, 100, 5)]
+        index = self.index_class(problems)
+        changed = index.remove([problems[3]])
+        self.assertEqual(len(changed), 1)
+        self.assertNotIn(problems[3], index.block(changed.pop()))
+        added = Problem(42, 3, 'RULE', 'Typos', 'typo')
+        changed = index.add([added])
+        self.assertTrue(any(added in index.block(serial) for serial in changed))
+        self.assertEqual([p for serial in index.blocks() for p in index.block(serial)],
+                         list(index))
+
+    def test_flush_after_partial_sync(self):
+        rng = random.Random(7)
+        problems = make_problems(rng, 1000, 10000)
+        index = self.index_class(problems)
+        naive = NaiveIndex(problems)
+        for _ in range(20):
+            a = rng.randrange(9000)
+            b = a + rng.randrange(20)
+            inserted = rng.randrange(20)
+            index.shift(a, b, inserted)
+            naive.shift(a, b, inserted)
+            # Bring some problems up to date, leaving others pending
+            index.at(rng.randrange(9000))
+        index.flush()
+        # offsets of the problems themselves, not read through the index
+        self.assertEqual({id(p): p.offset for p in problems},
+                         {id(p): offset for offset, p in naive.offsets()})
+
+    def test_add_and_remove_keep_order(self):
+        rng = random.Random(9)
+        problems = make_problems(rng, 30, 300)
+        index = self.index_class(problems[:20])
+        naive = NaiveIndex(problems[:20])
+        index.shift(100, 100, 10)
+        naive.shift(100, 100, 10)
+        index.add(problems[20:])
+        index.remove(problems[:5])
+        removed = set(map(id, problems[:5]))
+        expected = [(offset, p) for offset, p in naive.offsets() if id(p) not in removed]
+        expected += [(p.offset, p) for p in problems[20:]]
+        offsets = [p.offset for p in index]
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertEqual(sorted(offsets), sorted(offset for offset, p in expected))
+        self.assertEqual(set(map(id, index)), {id(p) for offset, p in expected})
+
+
+class SmallBlockIndexTest(ProblemIndexTest):
+    """Same tests, with problems spread over many blocks."""
+
+    index_class = SmallBlockIndex
+
+
+if __name__ == '__main__':
+    unittest.main()
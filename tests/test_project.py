@@ -0,0 +1,54 @@
+"""Tests of project checks, against the mock server of the benchmarks."""
+
+import unittest
+
+from support import plugin, sublime
+from mock_server import MockServer
+
+project = plugin.commands.project
+
+
+class ProjectCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer(density=0.5).start()
+        self.settings = sublime.load_settings('LanguageTool.sublime-settings')
+        self.settings.set('server', self.server.url)
+        plugin.cache.get_cache().clear()
+        # forget problems of views of other tests
+        plugin.utils.forget_all_views()
+        self.window = sublime.Window()
+        # ten problems per view
+        self.views = [self.window.new_file('word %d ' % index * 10 + '\n')
+                      for index in range(3)]
+
+    def tearDown(self):
+        self.settings.erase('max_retained_problems')
+        self.server.shutdown()
+
+    def check_project(self):
+        check = project.check_project(self.window)
+        sublime.run_main(timeout=10, until=lambda: check.complete and check.done == check.files)
+        return check
+
+    def test_results_wait_for_their_view(self):
+        self.check_project()
+        # results of the active view are applied right away
+        self.assertEqual(project.count_results(), (2, 20))
+        self.assertEqual(len(plugin.utils.get_problems(self.views[2])), 10)
+
+    def test_results_of_closed_views_are_dropped(self):
+        self.check_project()
+        plugin.commands.LanguageToolListener().on_close(self.views[0])
+        self.assertEqual(project.count_results(), (1, 10))
+
+    def test_results_are_bounded_by_the_budget(self):
+        self.settings.set('max_retained_problems', 25)
+        self.check_project()
+        files, problems = project.count_results()
+        self.assertLessEqual(problems + plugin.utils.count_retained_problems(), 25)
+        self.assertEqual(files, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
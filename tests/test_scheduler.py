@@ -0,0 +1,95 @@
+"""Tests of server.Scheduler against the mock server of the benchmarks."""
+
+import time
+import unittest
+
+from support import plugin
+from mock_server import MockServer
+
+Scheduler = plugin.server.Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer(density=1).start()
+        self.scheduler = Scheduler(1, {})
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+        self.server.shutdown()
+
+    def block(self):
+        """Keep the only worker busy, so that requests submitted next queue up."""
+        self.server.latency = 0.2
+        blocker = self.scheduler.submit(self.server.url, 'busy', 'en-GB', [])
+        while not self.server.requests:
+            time.sleep(0.01)
+        return blocker
+
+    def submit_queued(self, texts, language='en-US', **kwargs):
+        blocker = self.block()
+        futures = [self.scheduler.submit(self.server.url, text, language, [], **kwargs)
+                   for text in texts]
+        blocker.result(5)
+        return [future.result(5) for future in futures]
+
+    def test_merges_queued_requests_and_splits_matches(self):
+        results = self.submit_queued(['alpha beta', 'gamma', 'delta epsilon zeta'])
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual([[m.offset for m in r['matches']] for r in results],
+                         [[0, 6], [0], [0, 6, 14]])
+
+    def test_respects_request_size(self):
+        plugin.utils.get_settings().set('max_chunk_size', 12)
+        try:
+            self.submit_queued(['alpha beta', 'gamma', 'delta'])
+        finally:
+            plugin.utils.get_settings().erase('max_chunk_size')
+        # 'gamma' and 'delta' fit together, 'alpha beta' does not fit with them
+        self.assertEqual(self.server.requests, 3)
+
+    def test_does_not_merge_auto_language(self):
+        results = self.submit_queued(['alpha beta', 'gamma'], language='auto')
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual([len(r['matches']) for r in results], [2, 1])
+
+    def test_does_not_merge_different_rules(self):
+        blocker = self.block()
+        first = self.scheduler.submit(self.server.url, 'alpha', 'en-US', ['A'])
+        second = self.scheduler.submit(self.server.url, 'beta', 'en-US', ['B'])
+        blocker.result(5)
+        first.result(5), second.result(5)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_coalesces_identical_requests(self):
+        blocker = self.block()
+        first = self.scheduler.submit(self.server.url, 'alpha', 'en-US', [])
+        second = self.scheduler.submit(self.server.url, 'alpha', 'en-US', [])
+        blocker.result(5)
+        self.assertIsNot(first, second)
+        self.assertEqual(first.result(5), second.result(5))
+        self.assertEqual(self.server.requests, 2)
+
+    def test_coalesced_request_survives_one_cancellation(self):
+        blocker = self.block()
+        first = self.scheduler.submit(self.server.url, 'alpha', 'en-US', [])
+        second = self.scheduler.submit(self.server.url, 'alpha', 'en-US', [])
+        first.cancel()
+        blocker.result(5)
+        self.assertEqual(len(second.result(5)['matches']), 1)
+        self.assertTrue(first.cancelled())
+
+    def test_drops_request_cancelled_by_all_submitters(self):
+        blocker = self.block()
+        first = self.scheduler.submit(self.server.url, 'alpha', 'en-US', [])
+        second = self.scheduler.submit(self.server.url, 'alpha', 'en-US', [])
+        first.cancel()
+        second.cancel()
+        blocker.result(5)
+        self.scheduler.submit(self.server.url, 'beta', 'en-GB', []).result(5)
+        self.assertEqual(self.server.requests, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
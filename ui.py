@@ -1,4 +1,5 @@
 
+import re
 import sublime
 from .utils import *
 
@@ -10,7 +11,7 @@ def move_caret(view, i, j):
 
 
 def select_problem(view, problem):
-    reg = view.get_regions(problem['regionKey'])[0]
+    reg = get_region_for_problem(problem)
     move_caret(view, reg.a, reg.b)
     view.show_at_center(reg)
     show_problem(view, problem)
@@ -24,12 +25,39 @@ def is_problem_solved(view, problem):
     1. its region has zero length, or
     2. its contents have been changed.
     """
-    pb_regions = view.get_regions(problem['id'])
-    log("IsProblemSolved", pb_regions)
-    if len(pb_regions) == 0:
-        return False
-    region = pb_regions[0]
-    return region.empty() or (view.substr(region) != problem['originalContent'])
+    region = get_region_for_problem(problem)
+    return region.empty() or (view.substr(region) != problem.originalContent)
+
+
+def paragraph_region(view, region):
+    """Expand region to the paragraphs (delimited by blank lines) around it."""
+    begin = view.line(region.begin())
+    while begin.a > 0:
+        line = view.line(begin.a - 1)
+        if not view.substr(line).strip():
+            break
+        begin = line
+    end = view.line(region.end())
+    while end.b < view.size():
+        line = view.line(end.b + 1)
+        if not view.substr(line).strip():
+            break
+        end = line
+    return sublime.Region(begin.a, end.b)
+
+
+def discard_problems(view, regions):
+    """Forget problems of view which intersect any of the given regions."""
+    problems = get_problems(view)
+    discarded = []
+    for region in regions:
+        for problem in problems.after(region.begin() - problems.max_length - 1):
+            if problem.offset > region.end():
+                break
+            problem_region = get_region_for_problem(problem)
+            if problem_region.intersects(region) or region.contains(problem_region):
+                discarded.append(problem)
+    remove_problems(view, discarded)
 
 
 def show_problem(view, p):
@@ -37,14 +65,29 @@ def show_problem(view, p):
 
     log("ShowProblem", p)
 
-    msg = p['message']
-    if p['replacements']:
-        msg += '\n\nSuggestion(s): ' + ', '.join(p['replacements'])
-    if p['urls']:
-        msg += '\n\nMore Info: ' + '\n'.join(p['urls'])
+    msg = p.message
+    if p.replacements:
+        msg += '\n\nSuggestion(s): ' + ', '.join(p.replacements)
+    if p.urls:
+        msg += '\n\nMore Info: ' + '\n'.join(p.urls)
 
     view.show_popup(msg)
 
+_PROGRESS_FRAMES = ['[=   ]', '[ =  ]', '[  = ]', '[   =]', '[  = ]', '[ =  ]']
+
+def show_progress(view, get_status, frame=0):
+    """Animate a status bar entry while `get_status` returns a message."""
+    message = get_status()
+    if message is None:
+        view.erase_status('languagetool')
+        return
+    frame_text = _PROGRESS_FRAMES[frame % len(_PROGRESS_FRAMES)]
+    view.set_status('languagetool', '%s %s' % (message, frame_text))
+    sublime.set_timeout(lambda: show_progress(view, get_status, frame + 1), 100)
+
+def _is_ST2():
+    return int(sublime.version()) < 3000
+
 def show_panel_text(text):
     window = sublime.active_window()
     if _is_ST2():
@@ -60,7 +103,7 @@ def choose_suggestion(view, p, replacements, choice):
     """Handle suggestion list selection."""
     problems = view.__dict__.get("problems", [])
     if choice != -1:
-        r = view.get_regions(p['regionKey'])[0]
+        r = get_region_for_problem(p)
         view.run_command('insert', {'characters': replacements[choice]})
         c = r.a + len(replacements[choice])
         move_caret(view, c, c)  # move caret to end of region
@@ -73,35 +116,35 @@ def get_equal_problems(problems, x):
     """Find problems with same category and content as a given problem.
 
     Args:
-      problems (list): list of problems to compare.
-      x (dict): problem object to compare with.
+      problems (ProblemIndex): problems to compare.
+      x (Problem): problem object to compare with.
 
     Returns:
       list: list of problems equal to x.
 
     """
-
-    def is_equal(prob1, prob2):
-        same_category = prob1['category'] == prob2['category']
-        same_content = prob1['orgContent'] == prob2['orgContent']
-        return same_category and same_content
-
-    return [problem for problem in problems if is_equal(problem, x)]
+    return problems.equal_to(x)
 
 
 def handle_language_selection(ind, view):
     key = 'language_tool_language'
+    if ind == -1:
+        return
     if ind == 0:
         view.settings().erase(key)
+        # detect the language again, with the next check
+        forget_detected_language(view)
+        set_status_bar('language: autodetect')
     else:
         selected_language = view.languages[ind][1]
         view.settings().set(key, selected_language)
+        set_status_bar('language: %s' % view.languages[ind][0])
 
 
 def correct_problem(view, edit, problem, replacements):
 
     def clear_and_advance():
-        clear_region(view, problem['regionKey'])
+        remove_problems(view, [problem])
         move_caret(view, next_caret_pos, next_caret_pos)  # advance caret
         view.run_command("goto_next_language_problem")
 
@@ -109,17 +152,39 @@ def correct_problem(view, edit, problem, replacements):
         def callback_fun(i):
             choose_suggestion(view, problem, replacements, i)
             clear_and_advance()
-        view.window().show_quick_panel(replacements, callback_fun)
+        view.window().show_quick_panel(list(replacements), callback_fun)
 
     else:
-        region = view.get_regions(problem['regionKey'])[0]
+        region = get_region_for_problem(problem)
         view.replace(edit, region, replacements[0])
         next_caret_pos = region.a + len(replacements[0])
         clear_and_advance()
 
-def ignore_problem(p, v, edit):
-    clear_region(v, p['regionKey'])
-    v.insert(edit, v.size(), "")  # dummy edit to enable undoing ignore
+def ignore_problems(view, problems):
+    remove_problems(view, problems)
+
+def deactivate_rule_problems(rule):
+    """Hide problems of rule in all views, until it is activated again."""
+    for window in sublime.windows():
+        for view in window.views():
+            problems = get_problems(view).with_rule(rule)
+            if problems:
+                hidden = get_hidden_problems(view)
+                hidden.add(problems)
+                save_hidden_problems(view, hidden)
+                remove_problems(view, problems)
+
+def activate_rule_problems(rule):
+    """Restore hidden problems of rule which were not solved meanwhile."""
+    for window in sublime.windows():
+        for view in window.views():
+            hidden = get_hidden_problems(view)
+            problems = hidden.with_rule(rule)
+            if problems:
+                hidden.remove(problems)
+                save_hidden_problems(view, hidden)
+                problems = [p for p in problems if not is_problem_solved(view, p)]
+                render_highlights(view, add_problems(view, problems))
 
 def load_ignored_rules():
     ignored_rules_file = 'LanguageToolUser.sublime-settings'
@@ -132,59 +197,115 @@ def save_ignored_rules(ignored):
     settings.set('ignored', ignored)
     sublime.save_settings(ignored_rules_file)
 
-def clear_region(view, region_key):
-    r = view.get_regions(region_key)[0]
-    dummyRg = sublime.Region(r.a, r.a)
-    hscope = get_settings().get("highlight-scope", "comment")
-    view.add_regions(region_key, [dummyRg], hscope, "", sublime.DRAW_OUTLINED)
-
-
-# _HIGHLIGHTED_REGIONS = {}
-# def add_highlight_region(view, region_key, problem):
-#     global _HIGHLIGHTED_REGIONS
-#     problem['regionKey'] = region_key
-#     view_id = view.id()
-
-#     if view_id not in _HIGHLIGHTED_REGIONS:
-#         _HIGHLIGHTED_REGIONS[view_id] = []
-
-#     _HIGHLIGHTED_REGIONS[view_id][region_key] = region
+def remove_problems(view, problems):
+    """Forget problems of view and remove their highlights."""
+    if problems:
+        index = get_problems(view)
+        blocks = index.remove(problems)
+        save_problems(view, index)
+        render_highlights(view, blocks)
+
+
+# Problems are highlighted with one region set per category and block of the
+# problem index (see utils.ProblemIndex) rather than one per problem, so that
+# drawing them takes few calls to the editor, and redrawing after problems
+# were added or removed only touches their blocks.
+_HIGHLIGHT_KEYS = view_state({})  # view id -> {block serial: keys drawn}
+_CATEGORY_KEYS = {}
+
+def get_highlight_key(category, block):
+    prefix = _CATEGORY_KEYS.get(category)
+    if prefix is None:
+        prefix = 'languagetool.' + re.sub(r'\W+', '_', category.lower())
+        _CATEGORY_KEYS[category] = prefix
+    return '%s.%d' % (prefix, block)
+
+@timed('highlights.render')
+def render_highlights(view, blocks=None):
+    """Draw problems of view in given blocks of its index (default: all).
 
-#     view.add_regions(region_key, [], "text", "",
-#                           sublime.DRAW_SQUIGGLY_UNDERLINE | sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE)
-
-# def remove_highlight_region(view, region_key):
-#     view.erase_regions(region_key)
-#     if view.id() in _HIGHLIGHTED_REGIONS and re[view_id]:
-#         pass
+    Args:
+      blocks (set): serial numbers of blocks, as returned when adding or
+        removing problems. Highlights of blocks which are gone are erased.
+    """
+    index = get_problems(view)
+    drawn = _HIGHLIGHT_KEYS.setdefault(view.id(), {})
+    if blocks is None:
+        blocks = set(drawn).union(index.blocks())
+    for block in blocks:
+        groups = {}
+        for problem in index.block(block):
+            key = get_highlight_key(problem.category, block)
+            groups.setdefault(key, []).append(get_region_for_problem(problem))
+        for key, regions in groups.items():
+            log("RenderHighlights", key, len(regions))
+            view.add_regions(key, regions, "text", "",
+                                sublime.DRAW_SQUIGGLY_UNDERLINE | sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE | sublime.NO_UNDO)
+        for key in drawn.pop(block, set()).difference(groups):
+            view.erase_regions(key)
+        if groups:
+            drawn[block] = set(groups)
+
+def plugin_unloaded():
+    # State of the plugin is lost when it reloads: erase highlights it drew
+    for window in sublime.windows():
+        for view in window.views():
+            if view.id() in _HIGHLIGHT_KEYS:
+                erase_highlights(view)
+    forget_all_views()
+
+def erase_highlights(view):
+    for keys in _HIGHLIGHT_KEYS.pop(view.id(), {}).values():
+        for key in keys:
+            view.erase_regions(key)
+
+@timed('highlights.recompute')
+def recompute_highlights(view, edited=None):
+    """Drop solved problems and redraw highlights.
 
-def recompute_highlights(view):
+    Args:
+      view: view to update.
+      edited (list): regions edited since the last call. If given, only
+        problems around them are checked, and highlights are only redrawn
+        if any of them was solved; the editor moves the others along edits.
+    """
     problems = get_problems(view)
-    for problem in list(problems):
-        log("RecomputeHighlights", "handling problem", problem['id'])
-        region = get_region_for_problem(problem)
+    if edited is None:
+        candidates = problems
+    else:
+        candidates = []
+        for region in edited:
+            for problem in problems.after(region.begin() - problems.max_length - 1):
+                if problem.offset > region.end():
+                    break
+                candidates.append(problem)
+
+    solved = []
+    for problem in candidates:
         if is_problem_solved(view, problem):
-            log("RecomputeHighlights", "removing solved problem", problem['id'])
-            view.erase_regions(problem['id'])
-            problems.remove(problem)
-        else:
-            view.add_regions(problem['id'], [region], "text", "",
-                                sublime.DRAW_SQUIGGLY_UNDERLINE | sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE | sublime.NO_UNDO)
-    save_problems(view, problems)
+            log("RecomputeHighlights", "removing solved problem", problem.id)
+            solved.append(problem)
+
+    if edited is None:
+        problems.remove(solved)
+        save_problems(view, problems)
+        render_highlights(view)
+    else:
+        remove_problems(view, solved)
 
 def generate_html_popup(view, problem, show_all_replacements=False):
     window_id = view.window().id()
     view_id = view.id()
 
     if show_all_replacements:
-        index_max = len(problem['replacements'])
+        index_max = len(problem.replacements)
     else:
         index_max = 5
 
-    replacements = '<br/>'.join(f"- <a href='view:{window_id}/{view_id},replace:{problem['id']}/{i}'>Use '{r}'</a>" for i,r in enumerate(problem['replacements'][:index_max]))
+    replacements = '<br/>'.join(f"- <a href='view:{window_id}/{view_id},replace:{problem.id}/{i}'>Use '{r}'</a>" for i,r in enumerate(problem.replacements[:index_max]))
 
-    if len(problem['replacements']) > index_max:
-        replacements += f"<br/>- <a href='view:{window_id}/{view_id},showall:{problem['id']}'>Show all replacements</a>"
+    if len(problem.replacements) > index_max:
+        replacements += f"<br/>- <a href='view:{window_id}/{view_id},showall:{problem.id}'>Show all replacements</a>"
 
     log("UI", "replacements", replacements)
     return f"""
@@ -204,7 +325,7 @@ def generate_html_popup(view, problem, show_all_replacements=False):
                     font-size: 1.0rem;
                 }}
             </style>
-            <p>{problem['message']}</p>
+            <p>{problem.message}</p>
             <h1>Replacements</h1>
             <p>{replacements}</p>
         </body>
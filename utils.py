@@ -1,32 +1,472 @@
 
 import sublime
+import bisect
+import collections
+import functools
 import itertools
+import threading
+import time
 import traceback
 import fnmatch
+import re
+import sys
+
+# Per-view state functions
+
+_VIEW_STATES = []  # dicts and sets keyed by view id
+
+def view_state(state):
+    """Register a dict or set keyed by view id, to evict views from it.
+
+    Returns:
+      state, so that it can be used at its definition.
+    """
+    _VIEW_STATES.append(state)
+    return state
+
+def forget_view(view_id):
+    """Drop all state kept for a view (called when it closes)."""
+    for state in _VIEW_STATES:
+        if isinstance(state, dict):
+            state.pop(view_id, None)
+        else:
+            state.discard(view_id)
+
+def forget_all_views():
+    for state in _VIEW_STATES:
+        state.clear()
+
+# view id -> None, from the least to the most recently activated view
+_ACTIVATED = view_state(collections.OrderedDict())
+
+def note_activated(view):
+    _ACTIVATED[view.id()] = None
+    _ACTIVATED.move_to_end(view.id())
+
+def count_retained_problems():
+    """Return the number of problems held by views, hidden ones included."""
+    return sum(map(len, _PROBLEMS.values())) + sum(map(len, _HIDDEN_PROBLEMS.values()))
+
+def select_shed_views(keep):
+    """Choose views whose problems to forget to stay in the problem budget.
+
+    Args:
+      keep (set): ids of views whose problems are kept (the visible ones).
+
+    Returns:
+      list: ids of views, least recently activated first.
+    """
+    budget = get_settings().get('max_retained_problems', 100000)
+    total = count_retained_problems()
+    if total <= budget:
+        return []
+    holding = dict.fromkeys(itertools.chain(_PROBLEMS, _HIDDEN_PROBLEMS))
+    # views never activated since their problems were saved come first
+    order = [view_id for view_id in holding if view_id not in _ACTIVATED]
+    order.extend(view_id for view_id in _ACTIVATED if view_id in holding)
+    shed = []
+    for view_id in order:
+        if view_id in keep:
+            continue
+        total -= len(_PROBLEMS.get(view_id, ())) + len(_HIDDEN_PROBLEMS.get(view_id, ()))
+        shed.append(view_id)
+        if total <= budget:
+            break
+    return shed
+
 
 # Problem manipulation functions
 
-_PROBLEMS = {}
+_PROBLEMS = view_state({})
 def save_problems(view, problems):
     global _PROBLEMS
     view_id = view.id()
-    if view_id in _PROBLEMS and problems == []:
+    if not isinstance(problems, ProblemIndex):
+        problems = ProblemIndex(problems)
+    if view_id in _PROBLEMS and len(problems) == 0:
         del _PROBLEMS[view_id]
     else:
         _PROBLEMS[view_id] = problems
 
 def get_problems(view):
-    return _PROBLEMS[view.id()] if view.id() in _PROBLEMS else []
+    return _PROBLEMS[view.id()] if view.id() in _PROBLEMS else ProblemIndex()
+
+def add_problems(view, problems):
+    """Merge problems into those of view, keeping them sorted by offset.
+
+    Returns:
+      set: serial numbers of the blocks of the index changed.
+    """
+    index = get_problems(view)
+    blocks = index.add(problems)
+    save_problems(view, index)
+    return blocks
+
+# Problems of deactivated rules, kept up to date with edits so that they can
+# be restored when their rule is activated again
+_HIDDEN_PROBLEMS = view_state({})
+def save_hidden_problems(view, problems):
+    view_id = view.id()
+    if not isinstance(problems, ProblemIndex):
+        problems = ProblemIndex(problems)
+    if len(problems) == 0:
+        _HIDDEN_PROBLEMS.pop(view_id, None)
+    else:
+        _HIDDEN_PROBLEMS[view_id] = problems
+
+def get_hidden_problems(view):
+    return _HIDDEN_PROBLEMS.get(view.id()) or ProblemIndex()
+
+
+_BLOCK_SERIALS = itertools.count()
+
+class _Block:
+    """Consecutive problems of an index, with an offset delta not applied yet."""
+
+    __slots__ = ('problems', 'delta', 'serial')
+
+    def __init__(self, problems):
+        self.problems = problems
+        self.delta = 0
+        self.serial = next(_BLOCK_SERIALS)
+
+
+class ProblemIndex:
+    """Problems of a view, sorted by offset.
+
+    Problems are kept in consecutive blocks of up to 2 * BLOCK_SIZE problems.
+    Point lookups and navigation are binary searches over blocks, then within
+    one. Shifting problems after an edit only adds the offset delta to the
+    blocks after it, whose problems are brought up to date when they are
+    accessed, so problems obtained from the index are always accurate.
+    Insertion and removal only touch the blocks of the problems concerned,
+    and return their serial numbers, so that highlights can be redrawn
+    block by block (see ui.render_highlights).
+    Problems are also hashed by id, by rule and by (category, original
+    content), for bulk operations on all problems of a rule or all equal
+    problems.
+    """
+
+    BLOCK_SIZE = 256
+
+    def __init__(self, problems=()):
+        problems = sorted(problems, key=lambda problem: problem.offset)
+        self._blocks = [_Block(problems[start:start + self.BLOCK_SIZE])
+                        for start in range(0, len(problems), self.BLOCK_SIZE)]
+        self._block_of = {id(p): block for block in self._blocks for p in block.problems}
+        self._by_serial = {block.serial: block for block in self._blocks}
+        self._count = len(problems)
+        self.max_length = max((p.length for p in problems), default=0)  # upper bound
+        self._by_id = {p.id: p for p in problems if p.id is not None}
+        self._by_rule = None  # built on first use, see _index
+
+    def _index(self):
+        if self._by_rule is None:
+            self._by_rule = {}
+            self._by_content = {}
+            for problem in self:
+                self._hash(problem)
+
+    def _hash(self, problem):
+        self._by_rule.setdefault(problem.rule, {})[id(problem)] = problem
+        key = (problem.category, problem.originalContent)
+        self._by_content.setdefault(key, {})[id(problem)] = problem
+
+    def _unhash(self, problem):
+        for table, key in ((self._by_rule, problem.rule),
+                           (self._by_content, (problem.category, problem.originalContent))):
+            problems = table[key]
+            del problems[id(problem)]
+            if not problems:
+                del table[key]
+
+    def _sync(self, block):
+        """Apply the pending delta of block to its problems, and return them."""
+        if block.delta:
+            for problem in block.problems:
+                problem.offset += block.delta
+            block.delta = 0
+        return block.problems
+
+    def _locate(self, point):
+        """Find the first problem with offset >= point.
+
+        Returns:
+          tuple: (block index, index in the block), the block being synced;
+          the number of blocks if all problems start before point.
+        """
+        blocks = self._blocks
+        low, high = 0, len(blocks)
+        while low < high:
+            middle = (low + high) // 2
+            block = blocks[middle]
+            if block.problems[-1].offset + block.delta < point:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(blocks):
+            return low, 0
+        problems = self._sync(blocks[low])
+        return low, _bisect_offsets(problems, point)
+
+    def flush(self):
+        """Apply all pending deltas to the problems, in O(n)."""
+        for block in self._blocks:
+            self._sync(block)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter([p for block in self._blocks for p in self._sync(block)])
+
+    def __reversed__(self):
+        return reversed(list(self))
+
+    def blocks(self):
+        """Return serial numbers of the blocks of the index, in offset order."""
+        return [block.serial for block in self._blocks]
+
+    def block(self, serial):
+        """Return problems of the block with given serial (none if it is gone)."""
+        block = self._by_serial.get(serial)
+        return list(self._sync(block)) if block else []
+
+    def get(self, problem_id):
+        """Return the problem with given id, or None."""
+        problem = self._by_id.get(problem_id)
+        if problem is not None:
+            self._sync(self._block_of[id(problem)])
+        return problem
+
+    def at(self, point):
+        """Return the problem whose text contains point, or None."""
+        for problem in self.before(point + 1):
+            if problem.offset + self.max_length < point:
+                break
+            if problem.offset + problem.length >= point:
+                return problem
+        return None
+
+    def after(self, point):
+        """Iterate over problems starting after point, in offset order."""
+        index, position = self._locate(point + 1)
+        while index < len(self._blocks):
+            yield from self._sync(self._blocks[index])[position:]
+            index, position = index + 1, 0
+
+    def before(self, point):
+        """Iterate over problems starting before point, in reverse order."""
+        index, position = self._locate(point)
+        if position == 0:
+            index -= 1
+            position = None
+        while index >= 0:
+            yield from reversed(self._sync(self._blocks[index])[:position])
+            index, position = index - 1, None
+
+    def _get_all(self, table, key):
+        problems = list(table.get(key, {}).values())
+        for problem in problems:
+            self._sync(self._block_of[id(problem)])
+        return problems
+
+    def with_rule(self, rule):
+        """Return problems found by the given rule."""
+        self._index()
+        return self._get_all(self._by_rule, rule)
+
+    def equal_to(self, problem):
+        """Return problems of the same category and text as problem."""
+        self._index()
+        return self._get_all(self._by_content, (problem.category, problem.originalContent))
+
+    def shift(self, a, b, inserted):
+        """Update offsets after text [a, b) was replaced by `inserted` characters.
+
+        Problems starting after the change are shifted; problems starting
+        inside replaced text are moved to its beginning.
+        """
+        blocks = self._blocks
+        index, position = self._locate(a)
+        while index < len(blocks):
+            problems = self._sync(blocks[index])
+            while position < len(problems) and problems[position].offset < b:
+                problems[position].offset = a
+                position += 1
+            if position < len(problems):
+                break
+            index, position = index + 1, 0
+        delta = inserted - (b - a)
+        if delta and index < len(blocks):
+            for problem in blocks[index].problems[position:]:
+                problem.offset += delta
+            for index in range(index + 1, len(blocks)):
+                blocks[index].delta += delta
+
+    def add(self, problems):
+        """Insert problems, keeping the index sorted.
+
+        Returns:
+          set: serial numbers of the blocks changed.
+        """
+        changed = set()
+        for problem in sorted(problems, key=lambda problem: problem.offset):
+            if not self._blocks:
+                self._blocks.append(_Block([]))
+                self._by_serial[self._blocks[0].serial] = self._blocks[0]
+                index, position = 0, 0
+            else:
+                index, position = self._locate(problem.offset + 1)
+            if position == 0 and index > 0:
+                index -= 1  # append to the end of the previous block
+                position = len(self._sync(self._blocks[index]))
+            block = self._blocks[index]
+            block.problems.insert(position, problem)
+            self._block_of[id(problem)] = block
+            changed.add(block.serial)
+            if len(block.problems) > 2 * self.BLOCK_SIZE:
+                changed.add(self._split(index))
+            self._count += 1
+            self.max_length = max(self.max_length, problem.length)
+            if problem.id is not None:
+                self._by_id[problem.id] = problem
+            if self._by_rule is not None:
+                self._hash(problem)
+        return changed
+
+    def _split(self, index):
+        """Move the second half of a block to a new block, and return its serial."""
+        block = self._blocks[index]
+        half = len(block.problems) // 2
+        new = _Block(block.problems[half:])
+        del block.problems[half:]
+        self._blocks.insert(index + 1, new)
+        self._by_serial[new.serial] = new
+        for problem in new.problems:
+            self._block_of[id(problem)] = new
+        return new.serial
+
+    def remove(self, problems):
+        """Remove problems from the index.
+
+        Returns:
+          set: serial numbers of the blocks changed.
+        """
+        changed = set()
+        for problem in problems:
+            block = self._block_of.pop(id(problem), None)
+            if block is None:
+                continue  # not in the index
+            self._sync(block).remove(problem)
+            changed.add(block.serial)
+            if not block.problems:
+                self._blocks.remove(block)
+                del self._by_serial[block.serial]
+            self._count -= 1
+            if problem.id is not None:
+                self._by_id.pop(problem.id, None)
+            if self._by_rule is not None:
+                self._unhash(problem)
+        return changed
+
+def _bisect_offsets(problems, point):
+    """Return index of the first of sorted problems with offset >= point."""
+    low, high = 0, len(problems)
+    while low < high:
+        middle = (low + high) // 2
+        if problems[middle].offset < point:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class Problem:
+    """A problem found in the text.
+
+    Documents may hold tens of thousands of problems, whose strings mostly
+    repeat (categories, rule ids, messages, URLs, replacements): problems use
+    slots, and share these strings through interning.
+    """
+
+    __slots__ = ('offset', 'length', 'rule', 'category', 'message',
+                 'replacements', 'urls', 'originalContent', 'id')
+
+    def __init__(self, offset, length, rule, category, message,
+                 replacements=(), urls=()):
+        self.offset = offset
+        self.length = length
+        self.rule = sys.intern(rule)
+        self.category = sys.intern(category)
+        self.message = sys.intern(message)
+        self.replacements = tuple(map(sys.intern, replacements))
+        self.urls = share_urls(urls)
+        self.originalContent = None
+        self.id = None
+
+    def copy(self):
+        problem = Problem.__new__(Problem)
+        for field in self.__slots__:
+            setattr(problem, field, getattr(self, field))
+        return problem
+
+    def __repr__(self):
+        return 'Problem(%d, %d, %r, %r)' % (self.offset, self.length, self.rule,
+                                            self.message)
+
+_URLS = {}
+def share_urls(urls):
+    """Return urls as a tuple, shared by all problems with the same urls."""
+    urls = tuple(urls)
+    return _URLS.setdefault(urls, urls)
+
+_PROBLEM_IDS = itertools.count()
+def new_problem_id():
+    """Return a new problem id, unique for the session."""
+    return str(next(_PROBLEM_IDS))
 
 def shift_offset(problem, shift):
     """Shift problem offset by `shift`."""
-    problem['offset'] += shift
+    problem.offset += shift
     return problem
 
+def merge_edit(ranges, a, b, inserted):
+    """Update sorted, disjoint ranges after text [a, b) was replaced.
+
+    Ranges after the edit are shifted, and the inserted text is merged with
+    the ranges it touches.
+
+    Args:
+      ranges (list): [start, end] lists, sorted by start.
+      a, b (int): replaced text.
+      inserted (int): number of inserted characters.
+
+    Returns:
+      list: the updated ranges.
+    """
+    delta = inserted - (b - a)
+    new = [a, a + inserted]
+    result = []
+    for start, end in ranges:
+        if end < a:
+            result.append([start, end])
+        elif start > b:
+            if new:
+                result.append(new)
+                new = None
+            result.append([start + delta, end + delta])
+        else:
+            new[0] = min(new[0], start)
+            new[1] = max(new[1], end + delta)
+    if new:
+        result.append(new)
+    return result
+
 def get_region_for_problem(problem):
     """Returns a Region object corresponding to problem text."""
-    length = problem['length']
-    offset = problem['offset']
+    length = problem.length
+    offset = problem.offset
     return sublime.Region(offset, offset + length)
 
 def region_contains(region, problem):
@@ -36,10 +476,10 @@ def region_contains(region, problem):
 
 def is_ignored(view, point):
     """Return True if any scope at given point is ignored."""
-    scope_string = view.scope_name(point)
-    scopes = scope_string.split()
-    ignored_scopes = get_settings().get('ignored-scopes')
-    return cross_match(scopes, ignored_scopes, fnmatch.fnmatch)
+    index = _IGNORED_RANGES.get(view.id())
+    if index is not None:
+        return index.contains(point)
+    return is_ignored_scope(view.scope_name(point))
 
 def parse_match(match):
     """Parse a match object.
@@ -48,19 +488,321 @@ def parse_match(match):
       match (dict): match object returned by LanguageTool Server.
 
     Returns:
-      dict: problem object.
+      Problem: problem object.
     """
-    problem = {
-        'category': match['rule']['category']['name'],
-        'message': match['message'],
-        'replacements': [r['value'] for r in match['replacements']],
-        'rule': match['rule']['id'],
-        'urls': [w['value'] for w in match['rule'].get('urls', [])],
-        'offset': match['offset'],
-        'length': match['length']
-    }
+    rule = match['rule']
+    return Problem(match['offset'], match['length'], rule['id'],
+                   rule['category']['name'], match['message'],
+                   [replacement['value'] for replacement in match['replacements']],
+                   [url['value'] for url in rule.get('urls', ())])
 
-    return problem
+
+# Ignored scopes functions
+
+_IGNORED_MATCHER = None
+_IGNORED_SCOPES = {}  # scope string -> True if ignored
+_IGNORED_RANGES = view_state({})
+
+def _on_settings_change():
+    global _IGNORED_MATCHER
+    if _IGNORED_MATCHER is not None:
+        _IGNORED_MATCHER = None
+        _IGNORED_SCOPES.clear()
+        _IGNORED_RANGES.clear()
+
+def is_ignored_scope(scope_string):
+    """Return True if any scope of a scope string matches `ignored-scopes`.
+
+    The globs are compiled once into a single regular expression, and the
+    result is cached per scope string; both are reset when settings change.
+    """
+    global _IGNORED_MATCHER
+    ignored = _IGNORED_SCOPES.get(scope_string)
+    if ignored is None:
+        if _IGNORED_MATCHER is None:
+            settings = get_settings()
+            settings.clear_on_change('LanguageTool.ignored-scopes')
+            settings.add_on_change('LanguageTool.ignored-scopes', _on_settings_change)
+            globs = settings.get('ignored-scopes') or []
+            pattern = '|'.join(fnmatch.translate(glob) for glob in globs)
+            _IGNORED_MATCHER = re.compile(pattern or '(?!)')
+        ignored = any(map(_IGNORED_MATCHER.match, scope_string.split()))
+        _IGNORED_SCOPES[scope_string] = ignored
+    return ignored
+
+def index_ignored_ranges(view):
+    """(Re)build the index of ignored ranges of view."""
+    with timed('scopes.index'):
+        _IGNORED_RANGES[view.id()] = IgnoredRanges(view)
+
+def get_ignored_ranges(view):
+    """Return the index of ignored ranges of view, or None."""
+    return _IGNORED_RANGES.get(view.id())
+
+def shift_ignored_ranges(view, a, b, inserted):
+    index = _IGNORED_RANGES.get(view.id())
+    if index is not None:
+        index.shift(a, b, inserted)
+
+
+class IgnoredRanges:
+    """Sorted, disjoint ranges of a view whose scope is ignored.
+
+    Lookups are binary searches. Edits shift the ranges after them and mark
+    the edited lines for a re-scan, which is deferred to the next lookup.
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.starts = []
+        self.ends = []
+        self.dirty = []
+        self.scan(sublime.Region(0, view.size()))
+
+    def scan(self, region):
+        """Re-compute ignored ranges within region."""
+        first = bisect.bisect_right(self.ends, region.begin())
+        last = bisect.bisect_left(self.starts, region.end())
+        starts, ends = [], []
+        # keep parts of ranges sticking out of region
+        if first < last and self.starts[first] < region.begin():
+            starts.append(self.starts[first])
+            ends.append(region.begin())
+        for token, scope_string in self.view.extract_tokens_with_scopes(region):
+            if is_ignored_scope(scope_string):
+                if ends and ends[-1] == token.begin():
+                    ends[-1] = token.end()
+                else:
+                    starts.append(token.begin())
+                    ends.append(token.end())
+        if first < last and self.ends[last - 1] > region.end():
+            if ends and ends[-1] == region.end():
+                ends[-1] = self.ends[last - 1]
+            else:
+                starts.append(region.end())
+                ends.append(self.ends[last - 1])
+        self.starts[first:last] = starts
+        self.ends[first:last] = ends
+
+    def shift(self, a, b, inserted):
+        """Update ranges after text [a, b) was replaced by `inserted` characters."""
+        delta = inserted - (b - a)
+        first = bisect.bisect_right(self.ends, a)
+        last = bisect.bisect_left(self.starts, b)
+        for index in range(first, last):
+            self.starts[index] = min(self.starts[index], a)
+            if self.ends[index] >= b:
+                self.ends[index] += delta
+            else:
+                self.ends[index] = a
+        if delta:
+            self.starts[last:] = [start + delta for start in self.starts[last:]]
+            self.ends[last:] = [end + delta for end in self.ends[last:]]
+        self.dirty = merge_edit(self.dirty, a, b, inserted)
+
+    def refresh(self):
+        """Re-scan lines edited since the last lookup."""
+        if self.dirty:
+            for start, end in self.dirty:
+                self.scan(self.view.full_line(sublime.Region(start, end)))
+            self.dirty = []
+
+    def contains(self, point):
+        self.refresh()
+        index = bisect.bisect_right(self.starts, point) - 1
+        return index >= 0 and point < self.ends[index]
+
+    def within(self, a, b):
+        """Return ignored ranges intersecting [a, b), clipped to it."""
+        self.refresh()
+        first = bisect.bisect_right(self.ends, a)
+        last = bisect.bisect_left(self.starts, b)
+        return [(max(a, self.starts[index]), min(b, self.ends[index]))
+                for index in range(first, last)]
+
+
+# Language detection functions
+
+# view id -> [code, name, characters edited since detection, edit limit]
+_DETECTED_LANGUAGES = view_state({})
+
+def get_detected_language(view):
+    """Return (code, name) of the language pinned for view, or None."""
+    entry = _DETECTED_LANGUAGES.get(view.id())
+    return (entry[0], entry[1]) if entry else None
+
+def detect_language(view, detected):
+    """Pin the language the server detected in the text of view.
+
+    Does nothing if a language is already pinned, or if the server is not
+    confident enough (see `language_detection_confidence`).
+
+    Args:
+      detected (dict): `detectedLanguage` object of a check response.
+    """
+    if view.id() in _DETECTED_LANGUAGES or not detected:
+        return
+    settings = get_settings()
+    if detected.get('confidence', 0) < settings.get('language_detection_confidence', 0.9):
+        return
+    limit = max(view.size(), 1000) * settings.get('language_redetect_ratio', 0.5)
+    _DETECTED_LANGUAGES[view.id()] = [detected['code'], detected['name'], 0, limit]
+    log("Language", "pinned", detected['code'], "for view", view.id())
+
+def forget_detected_language(view):
+    _DETECTED_LANGUAGES.pop(view.id(), None)
+
+def track_language_edit(view, removed, inserted):
+    """Forget the language pinned for view once much of its text changed."""
+    entry = _DETECTED_LANGUAGES.get(view.id())
+    if entry:
+        entry[2] += removed + inserted
+        if entry[2] > entry[3]:
+            del _DETECTED_LANGUAGES[view.id()]
+            log("Language", "text changed, detecting language of view", view.id(), "again")
+
+
+# Text splitting functions
+
+_PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n\s*')
+_SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+')
+
+def text_size(text):
+    """Return size of text in bytes, as counted by LanguageTool Server."""
+    return len(text.encode('utf-8'))
+
+def split_at(text, pattern):
+    """Split text after each match of pattern.
+
+    Returns:
+      list: (offset, piece) tuples covering text entirely.
+    """
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        if match.end() > start:
+            pieces.append((start, text[start:match.end()]))
+            start = match.end()
+    if start < len(text):
+        pieces.append((start, text[start:]))
+    return pieces
+
+def split_paragraphs(text, max_size):
+    """Split text at paragraph boundaries into pieces of at most max_size bytes.
+
+    Paragraphs which are too large are split at sentence boundaries and, as
+    a last resort, anywhere.
+
+    Returns:
+      list: (offset, piece) tuples covering text entirely.
+    """
+    pieces = []
+    for offset, paragraph in split_at(text, _PARAGRAPH_BREAK):
+        if text_size(paragraph) <= max_size:
+            pieces.append((offset, paragraph))
+            continue
+        for sub_offset, sentence in split_at(paragraph, _SENTENCE_BREAK):
+            start = 0
+            while start < len(sentence):
+                end = start + max_size
+                while text_size(sentence[start:end]) > max_size:
+                    end -= (end - start) // 4 or 1
+                pieces.append((offset + sub_offset + start, sentence[start:end]))
+                start = end
+    return pieces
+
+def pack_pieces(pieces, max_size):
+    """Group consecutive pieces into batches of at most max_size bytes."""
+    batches = []
+    batch_size = 0
+    for piece in pieces:
+        size = text_size(piece[1])
+        if not batches or batch_size + size > max_size:
+            batches.append([])
+            batch_size = 0
+        batches[-1].append(piece)
+        batch_size += size
+    return batches
+
+
+# Diagnostics functions
+
+_TIMINGS = collections.deque(maxlen=2000)  # (phase, seconds) of recent runs
+_COUNTERS = collections.Counter()
+_COUNTERS_LOCK = threading.Lock()
+
+class timed:
+    """Record the time spent in a phase of the plugin.
+
+    Used either as a context manager or as a function decorator.
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _TIMINGS.append((self.phase, time.perf_counter() - self.start))
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _TIMINGS.append((self.phase, time.perf_counter() - start))
+        return wrapper
+
+def count(name, amount=1):
+    """Add amount to a diagnostics counter."""
+    with _COUNTERS_LOCK:
+        _COUNTERS[name] += amount
+
+def get_timings():
+    """Summarize recorded timings.
+
+    Returns:
+      list: (phase, calls, total, mean, max) tuples, in seconds, sorted by
+      decreasing total time.
+    """
+    phases = collections.defaultdict(list)
+    for phase, seconds in list(_TIMINGS):
+        phases[phase].append(seconds)
+    summary = [(phase, len(times), sum(times), sum(times) / len(times), max(times))
+               for phase, times in phases.items()]
+    return sorted(summary, key=lambda row: -row[2])
+
+def get_counters():
+    with _COUNTERS_LOCK:
+        return dict(_COUNTERS)
+
+def format_diagnostics():
+    """Return a plain text report of recorded timings and counters."""
+    lines = ['%-24s %7s %10s %10s %10s' % ('phase', 'calls', 'total ms', 'mean ms', 'max ms')]
+    for phase, calls, total, mean, longest in get_timings():
+        lines.append('%-24s %7d %10.2f %10.3f %10.3f'
+                     % (phase, calls, total * 1000, mean * 1000, longest * 1000))
+    counters = get_counters()
+    if counters:
+        lines.append('')
+        for name in sorted(counters):
+            lines.append('%-24s %d' % (name, counters[name]))
+    for kind in ('memory', 'disk'):
+        hits = counters.get('cache.%s_hits' % kind, 0)
+        misses = counters.get('cache.%s_misses' % kind, 0)
+        if hits + misses:
+            lines.append('%-24s %.1f%%' % ('cache.%s_hit_rate' % kind,
+                                          100.0 * hits / (hits + misses)))
+    return '\n'.join(lines) + '\n'
+
+def reset_diagnostics():
+    _TIMINGS.clear()
+    with _COUNTERS_LOCK:
+        _COUNTERS.clear()
 
 
 # Miscellaneous functions
@@ -78,8 +820,20 @@ def get_settings():
     settings = sublime.load_settings('LanguageTool.sublime-settings')
     return settings
 
+_DEBUG = None
+
+def _reset_debug():
+    global _DEBUG
+    _DEBUG = None
+
 def log(*args):
-    if get_settings().get('debug'):
+    global _DEBUG
+    if _DEBUG is None:
+        settings = get_settings()
+        settings.clear_on_change('LanguageTool.debug')
+        settings.add_on_change('LanguageTool.debug', _reset_debug)
+        _DEBUG = bool(settings.get('debug'))
+    if _DEBUG:
         print("LanguageTool:", *args)
 
 def set_status_bar(message):